@@ -0,0 +1,311 @@
+import os
+import sys
+import time
+import random
+import logging
+import threading
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import nullcontext
+
+try:
+    from instaloader import (
+        Instaloader, Profile, RateController, ConnectionException, InstaloaderException, LoginRequiredException,
+        PrivateProfileNotFollowedException, ProfileNotExistsException, QueryReturnedNotFoundException,
+        TooManyRequestsException
+    )
+except ModuleNotFoundError:
+    raise SystemExit("Instaloader not found.\n  pip install [--user] instaloader")
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "02-build-pages"))
+from archive_db import connect
+from fake_instagram import redirect_instagram
+
+logging.basicConfig(level=logging.INFO)
+
+# errors that will not go away by trying again
+PERMANENT_ERRORS = (ProfileNotExistsException, PrivateProfileNotFollowedException, LoginRequiredException, QueryReturnedNotFoundException)
+
+
+class RateLimiter:
+    """
+    Token bucket shared by all account jobs, so the pool as a whole stays below
+    `requests_per_minute` no matter how many accounts run in parallel.
+    """
+    def __init__(self, requests_per_minute, burst=5):
+        self.rate = requests_per_minute / 60
+        self.capacity = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if now >= self.paused_until and self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = max(self.paused_until - now, (1 - self.tokens) / self.rate)
+            time.sleep(wait)
+
+    def pause(self, seconds):
+        """
+        Stop all jobs for `seconds`, e.g. after Instagram answered 429.
+        """
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+
+class SharedRateController(RateController):
+    """
+    instaloader's per-session rate control plus the global limiter; counts the requests of one job.
+    """
+    def __init__(self, context, limiter, pause_on_429):
+        super().__init__(context)
+        self.limiter = limiter
+        self.pause_on_429 = pause_on_429
+        self.requests = 0
+
+    def wait_before_query(self, query_type):
+        self.limiter.acquire()
+        self.requests += 1
+        super().wait_before_query(query_type)
+
+    def handle_429(self, query_type):
+        # replaces instaloader's own wait of 10+ minutes: the retried request
+        # waits in wait_before_query until the shared pause is over
+        logging.warning(f"429 Too Many Requests, pausing all jobs for {self.pause_on_429}s")
+        self.limiter.pause(self.pause_on_429)
+
+
+class CrawlOrchestrator:
+    def __init__(self, db, base_directory, limiter, login=None, sessionfile=None, workers=3, retries=3,
+                 backoff=30.0, pause_on_429=600.0, sleep=True, fast_update=False, max_connection_attempts=10,
+                 runs_tbl="archive_crawl_runs", accounts_tbl="archive_crawl_accounts"):
+        self.db = db
+        self.base_directory = base_directory
+        self.limiter = limiter
+        self.login = login
+        self.sessionfile = sessionfile
+        self.workers = workers
+        self.retries = retries
+        self.backoff = backoff
+        self.pause_on_429 = pause_on_429
+        self.sleep = sleep
+        self.fast_update = fast_update
+        self.max_connection_attempts = max_connection_attempts
+        self.runs_tbl = runs_tbl
+        self.accounts_tbl = accounts_tbl
+        self.con = connect(db, readonly=False)
+        self.create_tables()
+
+    def create_tables(self):
+        self.con.executescript(f"""
+            CREATE TABLE IF NOT EXISTS {self.runs_tbl} (
+                run_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                started_at REAL,
+                finished_at REAL,
+                state TEXT
+            );
+            CREATE TABLE IF NOT EXISTS {self.accounts_tbl} (
+                run_id INTEGER,
+                username TEXT,
+                status TEXT,
+                attempts INTEGER DEFAULT 0,
+                started_at REAL,
+                finished_at REAL,
+                duration REAL,
+                requests INTEGER,
+                new_files INTEGER,
+                errors INTEGER,
+                last_error TEXT,
+                PRIMARY KEY (run_id, username)
+            );
+        """)
+        self.con.commit()
+
+    def start_run(self, usernames):
+        """
+        Continue the last unfinished run (skipping accounts that are done) or start a new one.
+        """
+        row = self.con.execute(f"SELECT run_id FROM {self.runs_tbl} WHERE state = 'running' ORDER BY run_id DESC LIMIT 1").fetchone()
+        if row:
+            run_id = row["run_id"]
+            logging.info(f"Resuming crawl run {run_id}")
+        else:
+            run_id = self.con.execute(f"INSERT INTO {self.runs_tbl} (started_at, state) VALUES (?, 'running')", (time.time(),)).lastrowid
+        self.con.executemany(
+            f"INSERT OR IGNORE INTO {self.accounts_tbl} (run_id, username, status) VALUES (?, ?, 'pending')",
+            [(run_id, username) for username in usernames]
+        )
+        self.con.commit()
+        done = {r["username"] for r in self.con.execute(f"SELECT username FROM {self.accounts_tbl} WHERE run_id = ? AND status IN ('done', 'failed')", (run_id,))}
+        return run_id, [username for username in usernames if username not in done]
+
+    def create_loader(self, rate_controller):
+        loader = Instaloader(
+            sleep=self.sleep,
+            quiet=True,
+            dirname_pattern=os.path.join(self.base_directory, "{target}"),
+            filename_pattern="{date_utc:%Y}/{shortcode}_{date_utc}_UTC",
+            download_comments=True,
+            max_connection_attempts=self.max_connection_attempts,
+            rate_controller=rate_controller,
+            sanitize_paths=True
+        )
+        if self.login:
+            loader.load_session_from_file(self.login, self.sessionfile)
+        return loader
+
+    def count_files(self, username):
+        return sum(len(files) for _, _, files in os.walk(os.path.join(self.base_directory, username)))
+
+    def download_account(self, username, stats):
+        """
+        Download one account, like `instaloader --stories --highlights --tagged --reels --comments`.
+        Adds the requests made and the errors instaloader logged to `stats`.
+        """
+        controller = None
+
+        def rate_controller(context):
+            nonlocal controller
+            controller = SharedRateController(context, self.limiter, self.pause_on_429)
+            return controller
+
+        loader = self.create_loader(rate_controller)
+        try:
+            profile = Profile.from_username(loader.context, username)
+            logged_in = loader.context.is_logged_in
+            loader.download_profiles(
+                {profile}, tagged=True, highlights=logged_in, stories=logged_in, reels=True,
+                fast_update=self.fast_update, raise_errors=True
+            )
+        finally:
+            stats["requests"] += controller.requests
+            stats["errors"] += len(loader.context.error_log)
+            loader.close()
+
+    def crawl_account(self, username):
+        """
+        Job for one account: retries with exponential backoff and returns the stats for the DB.
+        Never raises, so every account ends up checkpointed as done or failed.
+        """
+        stats = {"username": username, "started_at": time.time(), "attempts": 0, "requests": 0, "errors": 0, "last_error": None}
+        files_before = self.count_files(username)
+        while True:
+            stats["attempts"] += 1
+            try:
+                self.download_account(username, stats)
+                stats.update(status="done", last_error=None)
+                break
+            except PERMANENT_ERRORS as e:
+                stats.update(status="failed", last_error=str(e))
+                break
+            except ConnectionException as e:
+                stats["last_error"] = str(e)
+                if isinstance(e, TooManyRequestsException) or isinstance(e.__cause__, TooManyRequestsException):
+                    logging.warning(f"{username}: 429 Too Many Requests, pausing all jobs for {self.pause_on_429}s")
+                    self.limiter.pause(self.pause_on_429)
+                if stats["attempts"] > self.retries:
+                    stats["status"] = "failed"
+                    break
+                wait = self.backoff * 2 ** (stats["attempts"] - 1) * random.uniform(0.8, 1.2)
+                logging.warning(f"{username}: attempt {stats['attempts']} failed ({e}), retrying in {wait:.0f}s")
+                time.sleep(wait)
+            except InstaloaderException as e:
+                # e.g. BadResponseException: unexpected answers are not retried
+                stats.update(status="failed", last_error=f"{type(e).__name__}: {e}")
+                break
+            except Exception as e:
+                # changed JSON structure, missing session file, ...
+                logging.exception(f"{username}: unexpected error")
+                stats.update(status="failed", last_error=f"{type(e).__name__}: {e}")
+                break
+        return self.finish_stats(stats, files_before)
+
+    def finish_stats(self, stats, files_before):
+        stats["finished_at"] = time.time()
+        stats["duration"] = stats["finished_at"] - stats["started_at"]
+        stats["new_files"] = self.count_files(stats["username"]) - files_before
+        return stats
+
+    def save_stats(self, run_id, stats):
+        self.con.execute(
+            f"""
+            UPDATE {self.accounts_tbl}
+            SET status = ?, attempts = attempts + ?, started_at = ?, finished_at = ?, duration = ?,
+                requests = ?, new_files = ?, errors = ?, last_error = ?
+            WHERE run_id = ? AND username = ?
+            """,
+            (stats["status"], stats["attempts"], stats["started_at"], stats["finished_at"], stats["duration"],
+             stats["requests"], stats["new_files"], stats["errors"], stats["last_error"], run_id, stats["username"])
+        )
+        self.con.commit()
+
+    def run(self, usernames):
+        run_id, todo = self.start_run(usernames)
+        logging.info(f"Crawl run {run_id}: {len(todo)} of {len(usernames)} accounts to do, {self.workers} at a time")
+
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            jobs = {executor.submit(self.crawl_account, username): username for username in todo}
+            for job in as_completed(jobs):
+                try:
+                    stats = job.result()
+                except Exception as e:
+                    # crawl_account handles its errors, this only guards the checkpoint of the other jobs
+                    logging.exception(f"{jobs[job]}: job crashed")
+                    stats = {"username": jobs[job], "status": "failed", "attempts": 1, "started_at": None, "finished_at": time.time(),
+                             "duration": 0.0, "requests": 0, "new_files": 0, "errors": 1, "last_error": f"{type(e).__name__}: {e}"}
+                self.save_stats(run_id, stats)
+                logging.info(
+                    f"{stats['username']}: {stats['status']} after {stats['attempts']} attempt(s), "
+                    f"{stats['duration']:.1f}s, {stats['requests']} requests, {stats['new_files']} new files"
+                    + (f" ({stats['last_error']})" if stats["status"] == "failed" else "")
+                )
+
+        self.con.execute(f"UPDATE {self.runs_tbl} SET state = 'finished', finished_at = ? WHERE run_id = ?", (time.time(), run_id))
+        self.con.commit()
+        return run_id
+
+
+def read_accounts(path):
+    with open(path, encoding="utf-8") as f:
+        return [line.strip() for line in f if line.strip() and not line.startswith("#")]
+
+
+def main():
+    p = ArgumentParser(description="Crawl all accounts in accounts.txt in parallel, with per-account checkpoints.")
+    p.add_argument("--accounts", default="01-get-instagram-posts/accounts.txt")
+    p.add_argument("--data-dir", default="data")
+    p.add_argument("--db", default="data/instagram.sqlite")
+    p.add_argument("-l", "--login", help="Instagram account whose session was saved by 00-import-brower-session.py")
+    p.add_argument("-f", "--sessionfile")
+    p.add_argument("--workers", type=int, default=3, help="accounts crawled at the same time")
+    p.add_argument("--requests-per-minute", type=float, default=30, help="global limit across all workers")
+    p.add_argument("--retries", type=int, default=3)
+    p.add_argument("--backoff", type=float, default=30, help="seconds before the first retry, doubled for each further one")
+    p.add_argument("--pause-on-429", type=float, default=600, help="seconds all workers pause after a 429")
+    p.add_argument("--max-connection-attempts", type=int, default=10)
+    p.add_argument("--fast-update", action="store_true")
+    p.add_argument("--no-sleep", action="store_true", help="disable instaloader's random delays")
+    p.add_argument("--instagram-url", help="send all requests to this URL instead, e.g. a fake_instagram.py server")
+    args = p.parse_args()
+
+    os.makedirs(args.data_dir, exist_ok=True)
+    orchestrator = CrawlOrchestrator(
+        args.db, args.data_dir, RateLimiter(args.requests_per_minute),
+        login=args.login, sessionfile=args.sessionfile, workers=args.workers, retries=args.retries,
+        backoff=args.backoff, pause_on_429=args.pause_on_429, sleep=not args.no_sleep,
+        fast_update=args.fast_update, max_connection_attempts=args.max_connection_attempts
+    )
+    with redirect_instagram(args.instagram_url) if args.instagram_url else nullcontext():
+        orchestrator.run(read_accounts(args.accounts))
+    orchestrator.con.close()
+
+
+if __name__ == "__main__":
+    main()
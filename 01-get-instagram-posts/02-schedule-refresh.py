@@ -0,0 +1,215 @@
+import os
+import sys
+import math
+import time
+import bisect
+import logging
+import sqlite3
+import statistics
+from argparse import ArgumentParser
+from collections import defaultdict
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "02-build-pages"))
+from archive_db import connect
+
+logging.basicConfig(level=logging.INFO)
+
+DAY = 86400
+# instaloader fetches 12 posts per timeline page
+POSTS_PER_PAGE = 12
+
+
+class RefreshScheduler:
+    """
+    Decides which accounts to refresh in a run. Every account gets a refresh
+    interval from its recent posting rate; among the accounts that are due, the
+    ones with the most expected new posts are taken first until the request
+    budget of the run is used up.
+    """
+    def __init__(self, window_days=90, target_posts=2, min_interval_days=1, max_interval_days=30, base_cost=8):
+        self.window = window_days * DAY
+        self.target_posts = target_posts
+        self.min_interval = min_interval_days * DAY
+        self.max_interval = max_interval_days * DAY
+        self.base_cost = base_cost
+
+    def posting_rate(self, timestamps, now):
+        """
+        Posts per second within the window before `now`; `timestamps` must be sorted.
+        """
+        end = bisect.bisect_right(timestamps, now)
+        start = bisect.bisect_right(timestamps, now - self.window)
+        return (end - start) / self.window
+
+    def refresh_interval(self, rate):
+        if rate <= 0:
+            return self.max_interval
+        return min(max(self.target_posts / rate, self.min_interval), self.max_interval)
+
+    def estimated_cost(self, expected_posts):
+        return self.base_cost + math.ceil(expected_posts / POSTS_PER_PAGE)
+
+    def plan(self, timestamps_by_account, last_refresh, now, budget):
+        """
+        Returns (due accounts in order of priority, all account plans). Accounts
+        without a recorded refresh are always due.
+        """
+        plans = []
+        for username, timestamps in timestamps_by_account.items():
+            rate = self.posting_rate(timestamps, now)
+            interval = self.refresh_interval(rate)
+            last = last_refresh.get(username)
+            elapsed = now - last if last is not None else math.inf
+            expected_posts = rate * elapsed if last is not None else len(timestamps)
+            plans.append({
+                "username": username,
+                "posts_per_week": rate * 7 * DAY,
+                "interval_days": interval / DAY,
+                "last_post": timestamps[-1] if timestamps else None,
+                "days_since_refresh": elapsed / DAY,
+                "expected_posts": expected_posts,
+                "due": elapsed >= interval,
+                # dormant accounts still move up the queue as they become overdue
+                "priority": max(expected_posts, elapsed / self.max_interval),
+                "cost": self.estimated_cost(0 if last is None else expected_posts)
+            })
+
+        due, spent = [], 0
+        for plan in sorted((p for p in plans if p["due"]), key=lambda p: p["priority"], reverse=True):
+            if spent + plan["cost"] > budget:
+                continue
+            due.append(plan)
+            spent += plan["cost"]
+        return due, plans
+
+    def simulate(self, timestamps_by_account, days, budget):
+        """
+        Replay the last `days` days of posts: once a day either refresh every
+        account (what the crawl does today) or only the scheduled ones. Returns
+        the requests made and how long posts waited until they were captured.
+        """
+        end = max((ts[-1] for ts in timestamps_by_account.values() if ts), default=time.time())
+        start = end - days * DAY
+        results = {}
+        for mode in ["all", "adaptive"]:
+            last_refresh = {username: start for username in timestamps_by_account}
+            requests, delays = 0, []
+            for day in range(1, days + 1):
+                now = start + day * DAY
+                if mode == "all":
+                    refreshed = list(timestamps_by_account)
+                else:
+                    due, _ = self.plan(timestamps_by_account, last_refresh, now, budget)
+                    refreshed = [plan["username"] for plan in due]
+                for username in refreshed:
+                    timestamps = timestamps_by_account[username]
+                    lo = bisect.bisect_right(timestamps, last_refresh[username])
+                    hi = bisect.bisect_right(timestamps, now)
+                    delays.extend(now - ts for ts in timestamps[lo:hi])
+                    requests += self.estimated_cost(hi - lo)
+                    last_refresh[username] = now
+            # posts that were not captured by the end of the simulation
+            missed = sum(len(ts) - bisect.bisect_right(ts, last_refresh[u]) for u, ts in timestamps_by_account.items())
+            results[mode] = {"requests": requests, "delays": delays, "missed": missed}
+        return results
+
+
+def load_timestamps(con, accounts):
+    """
+    Sorted post timestamps per account (own posts and stories, not tagged posts).
+    """
+    timestamps = {username: [] for username in accounts}
+    rows = con.execute(
+        """
+        SELECT DISTINCT m.username, p.shortcode, p.timestamp
+        FROM archive_files p
+        JOIN archive_files_metadata m ON p.path = m.path
+        WHERE p.type IN ('post', 'story') AND p.timestamp IS NOT NULL
+        """
+    )
+    for row in rows:
+        if row["username"] in timestamps:
+            timestamps[row["username"]].append(row["timestamp"])
+    for values in timestamps.values():
+        values.sort()
+    return timestamps
+
+
+def load_last_refresh(con):
+    """
+    Last time an account was crawled: newest downloaded file or finished crawl job.
+    """
+    last_refresh = defaultdict(float)
+    for row in con.execute("SELECT username, MAX(downloaded_at) AS last FROM archive_files_metadata GROUP BY username"):
+        if row["last"]:
+            last_refresh[row["username"]] = float(row["last"])
+    try:
+        for row in con.execute("SELECT username, MAX(finished_at) AS last FROM archive_crawl_accounts WHERE status = 'done' GROUP BY username"):
+            last_refresh[row["username"]] = max(last_refresh[row["username"]], row["last"])
+    except sqlite3.OperationalError:
+        # no crawl has been run with 01-crawl-accounts.py yet
+        pass
+    return {username: last for username, last in last_refresh.items() if last}
+
+
+def format_day(timestamp):
+    return time.strftime("%Y-%m-%d", time.localtime(timestamp)) if timestamp else "-"
+
+
+def log_simulation(results, days, accounts):
+    for mode, label in [("all", "refresh all daily"), ("adaptive", "adaptive schedule")]:
+        result = results[mode]
+        delays = [delay / DAY for delay in result["delays"]] or [0]
+        p95 = statistics.quantiles(delays, n=20)[-1] if len(delays) > 1 else delays[0]
+        logging.info(
+            f"{label:>18}: {result['requests']:7d} requests, capture delay median {statistics.median(delays):.1f} days, "
+            f"p95 {p95:.1f} days, {result['missed']} posts not captured yet"
+        )
+    saved = results["all"]["requests"] - results["adaptive"]["requests"]
+    share = saved / results["all"]["requests"] if results["all"]["requests"] else 0
+    logging.info(f"Replaying {days} days for {accounts} accounts saves {saved} requests ({share:.0%})")
+
+
+def main():
+    p = ArgumentParser(description="Choose the accounts to refresh in this run based on their posting activity.")
+    p.add_argument("--accounts", default="01-get-instagram-posts/accounts.txt")
+    p.add_argument("--db", default="data/instagram.sqlite")
+    p.add_argument("--output", default="01-get-instagram-posts/due-accounts.txt", help="due accounts, usable as --accounts for 01-crawl-accounts.py")
+    p.add_argument("--budget", type=int, default=500, help="requests per day")
+    p.add_argument("--runs-per-day", type=int, default=1)
+    p.add_argument("--window-days", type=int, default=90, help="days of history used for the posting rate")
+    p.add_argument("--target-posts", type=float, default=2, help="refresh once about this many new posts are expected")
+    p.add_argument("--min-interval", type=float, default=1, help="days")
+    p.add_argument("--max-interval", type=float, default=30, help="days")
+    p.add_argument("--base-cost", type=int, default=8, help="requests per account refresh without new posts")
+    p.add_argument("--simulate", type=int, metavar="DAYS", help="replay the last DAYS days instead of scheduling")
+    args = p.parse_args()
+
+    with open(args.accounts, encoding="utf-8") as f:
+        accounts = [line.strip() for line in f if line.strip() and not line.startswith("#")]
+    scheduler = RefreshScheduler(args.window_days, args.target_posts, args.min_interval, args.max_interval, args.base_cost)
+    budget = args.budget / args.runs_per_day
+
+    con = connect(args.db)
+    timestamps = load_timestamps(con, accounts)
+    if args.simulate:
+        log_simulation(scheduler.simulate(timestamps, args.simulate, budget), args.simulate, len(accounts))
+        con.close()
+        return
+
+    due, plans = scheduler.plan(timestamps, load_last_refresh(con), time.time(), budget)
+    con.close()
+    due_usernames = {plan["username"] for plan in due}
+    for plan in sorted(plans, key=lambda p: p["priority"], reverse=True):
+        logging.info(
+            f"{'DUE ' if plan['username'] in due_usernames else '    '}{plan['username']:<30} {plan['posts_per_week']:5.1f} posts/week, "
+            f"every {plan['interval_days']:4.1f} days, last post {format_day(plan['last_post'])}, "
+            f"{plan['days_since_refresh']:5.1f} days since refresh, ~{plan['cost']} requests"
+        )
+    with open(args.output, "w", encoding="utf-8") as f:
+        f.writelines(f"{plan['username']}\n" for plan in due)
+    logging.info(f"{len(due)} of {len(accounts)} accounts due, ~{sum(p['cost'] for p in due)} of {budget:.0f} requests, written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,159 @@
+"""
+Minimal local stand-in for the Instagram endpoints instaloader uses to download
+a profile. Used to try out 01-crawl-accounts.py without touching Instagram:
+
+    python 01-get-instagram-posts/fake_instagram.py --port 8090 --fail forummuenchenev=500,429
+    python 01-get-instagram-posts/01-crawl-accounts.py --instagram-url http://127.0.0.1:8090 --no-sleep
+"""
+import json
+import threading
+from argparse import ArgumentParser
+from collections import Counter
+from contextlib import contextmanager
+from email.utils import formatdate
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+import requests
+
+INSTAGRAM_HOSTS = ("instagram.com", "cdninstagram.com", "fbcdn.net")
+
+EMPTY_CONNECTION = {"count": 0, "edges": [], "page_info": {"has_next_page": False, "end_cursor": None}}
+# every paginated query instaloader runs for a profile gets an empty page
+EMPTY_PAGES = {
+    "status": "ok",
+    "data": {
+        "xdt_api__v1__feed__user_timeline_graphql_connection": EMPTY_CONNECTION,
+        "xdt_api__v1__clips__user__connection_v2": EMPTY_CONNECTION,
+        "user": {
+            "edge_user_to_photos_of_you": EMPTY_CONNECTION,
+            "edge_felix_video_timeline": EMPTY_CONNECTION
+        }
+    }
+}
+
+
+class FakeInstagram(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, usernames, failures=None):
+        """
+        `failures` maps a username to a list of HTTP status codes that are
+        returned (in order) for its profile requests before it succeeds.
+        """
+        super().__init__(address, FakeInstagramHandler)
+        self.usernames = list(usernames)
+        self.failures = {username: list(codes) for username, codes in (failures or {}).items()}
+        self.requests = Counter()
+        self.lock = threading.Lock()
+
+    @property
+    def url(self):
+        return f"http://{self.server_address[0]}:{self.server_address[1]}"
+
+    def next_failure(self, username):
+        with self.lock:
+            self.requests[username] += 1
+            codes = self.failures.get(username)
+            return codes.pop(0) if codes else None
+
+    def profile_node(self, username):
+        return {
+            "id": str(1000 + self.usernames.index(username)),
+            "username": username,
+            "full_name": username.title(),
+            "biography": "",
+            "is_private": False,
+            "is_verified": False,
+            "followed_by_viewer": False,
+            "profile_pic_url_hd": f"https://scontent.cdninstagram.com/pics/{username}.jpg",
+            "edge_follow": {"count": 0},
+            "edge_followed_by": {"count": 0},
+            "edge_owner_to_timeline_media": EMPTY_CONNECTION,
+            "edge_felix_video_timeline": EMPTY_CONNECTION
+        }
+
+
+class FakeInstagramHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        url = urlsplit(self.path)
+        params = parse_qs(url.query)
+
+        if url.path.startswith("/api/v1/users/web_profile_info"):
+            username = params.get("username", [""])[0]
+            failure = self.server.next_failure(username)
+            if failure:
+                return self.send_json({"status": "fail", "message": "fake failure"}, status=failure)
+            user = self.server.profile_node(username) if username in self.server.usernames else None
+            return self.send_json({"status": "ok", "data": {"user": user}})
+
+        if url.path.startswith("/graphql/query"):
+            return self.send_json(EMPTY_PAGES)
+
+        if url.path.startswith("/pics/"):
+            body = b"\xff\xd8\xff\xe0fake-jpeg"
+            self.send_response(200)
+            self.send_header("Content-Type", "image/jpeg")
+            self.send_header("Content-Length", str(len(body)))
+            self.send_header("Last-Modified", formatdate(0, usegmt=True))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+
+        self.send_json({"status": "fail", "message": "not found"}, status=404)
+
+    do_POST = do_GET
+
+    def send_json(self, data, status=200):
+        body = json.dumps(data).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@contextmanager
+def redirect_instagram(base_url):
+    """
+    Send every request to an Instagram host to `base_url` instead. instaloader
+    creates new requests sessions internally, so this patches requests.Session
+    itself for the duration of the block.
+    """
+    original_request = requests.Session.request
+
+    def request(self, method, url, *args, **kwargs):
+        parts = urlsplit(url)
+        if parts.hostname and parts.hostname.endswith(INSTAGRAM_HOSTS):
+            url = base_url.rstrip("/") + parts.path + (f"?{parts.query}" if parts.query else "")
+        return original_request(self, method, url, *args, **kwargs)
+
+    requests.Session.request = request
+    try:
+        yield
+    finally:
+        requests.Session.request = original_request
+
+
+def parse_failures(values):
+    failures = {}
+    for value in values or []:
+        username, _, codes = value.partition("=")
+        failures[username] = [int(code) for code in codes.split(",") if code]
+    return failures
+
+
+if __name__ == "__main__":
+    p = ArgumentParser()
+    p.add_argument("--port", type=int, default=8090)
+    p.add_argument("--accounts", default="01-get-instagram-posts/accounts.txt")
+    p.add_argument("--fail", action="append", help="USERNAME=CODE,CODE,... status codes to answer first")
+    args = p.parse_args()
+    with open(args.accounts, encoding="utf-8") as f:
+        usernames = [line.strip() for line in f if line.strip()]
+    server = FakeInstagram(("127.0.0.1", args.port), usernames, parse_failures(args.fail))
+    print(f"Fake Instagram for {len(usernames)} accounts on {server.url}")
+    server.serve_forever()
@@ -0,0 +1,224 @@
+import os
+import json
+import shutil
+import logging
+
+import pandas as pd
+
+try:
+    import pyarrow
+except ModuleNotFoundError:
+    pyarrow = None
+
+from archive_db import connect, snapshot
+
+MANIFEST = "_manifest.json"
+# one unit for all timestamps, so every partition has the same schema
+DATETIME_TYPE = "datetime64[ms, UTC]"
+# everything the exporter writes into the output directory, removed by --full
+OUTPUT_PATHS = ("posts", "connections", "accounts.parquet", MANIFEST)
+# instaloader file names contain the UTC date of the post, e.g. XYZ_2024-05-01_10-00-00_UTC
+PATH_YEAR = r"_(\d{4})-\d{2}-\d{2}_\d{2}-\d{2}-\d{2}_UTC"
+
+# column types in the Parquet files, everything else is written as string
+POSTS_TYPES = {
+    "created_at": "datetime", "updated_at": "datetime", "downloaded_at": "epoch", "timestamp": "epoch",
+    "expiring_at": "epoch", "is_story": "boolean", "like_count": "Int64", "comments_count": "Int64",
+    # partition key, must stay numeric to group by it
+    "year": "Int64"
+}
+ACCOUNT_TYPES = {
+    "created_at": "datetime", "updated_at": "datetime", "last_update": "datetime", "id": "Int64",
+    "is_private": "boolean", "is_verified": "boolean", "is_business_account": "boolean",
+    "is_professional_account": "boolean", "follows": "Int64", "follower": "Int64"
+}
+CONNECTION_TYPES = {"created_at": "datetime", "updated_at": "datetime", "year": "Int64"}
+
+
+def apply_types(df, types):
+    for column in df.columns:
+        kind = types.get(column, "string")
+        if kind == "datetime":
+            df[column] = pd.to_datetime(df[column], errors="coerce", utc=True).astype(DATETIME_TYPE)
+        elif kind == "epoch":
+            df[column] = pd.to_datetime(pd.to_numeric(df[column], errors="coerce"), unit="s", utc=True).astype(DATETIME_TYPE)
+        elif kind == "boolean":
+            # RSQLite writes logicals as 0/1, older rows may contain "TRUE"/"FALSE"
+            values = df[column].map(lambda v: None if v is None or pd.isna(v) else str(v).strip().lower() in ("1", "true"))
+            df[column] = values.astype("boolean")
+        elif kind == "Int64":
+            df[column] = pd.to_numeric(df[column], errors="coerce").astype("Int64")
+        else:
+            df[column] = df[column].astype("string")
+    return df
+
+
+def content_hash(df):
+    """
+    Order independent fingerprint of a partition's rows.
+    """
+    return f"{len(df)}-{int(pd.util.hash_pandas_object(df, index=False).sum()) % 2**64:016x}"
+
+
+def write_parquet(df, path):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    df.to_parquet(tmp_path, engine="pyarrow", index=False, compression="zstd")
+    os.replace(tmp_path, path)
+
+
+class AnalyticsExporter:
+    """
+    Writes posts and connections as Parquet datasets partitioned by account and
+    year (`posts/account=<username>/year=<year>/part-0.parquet`), profiles as one
+    file. A manifest records a fingerprint per account and partition, so a run
+    only reads the accounts that changed in the DB and only rewrites the
+    partitions whose rows changed.
+    """
+    def __init__(self, processor, output_dir):
+        self.processor = processor
+        self.output_dir = output_dir
+        self.manifest_path = os.path.join(output_dir, MANIFEST)
+
+    def load_manifest(self):
+        if os.path.exists(self.manifest_path):
+            with open(self.manifest_path, encoding="utf-8") as f:
+                return json.load(f)
+        return {}
+
+    def save_manifest(self, manifest):
+        tmp_path = f"{self.manifest_path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(manifest, f, indent=1, sort_keys=True)
+        os.replace(tmp_path, self.manifest_path)
+
+    def account_fingerprints(self, con, sql):
+        """
+        {account: fingerprint} from one aggregate query returning (account, ...) rows.
+        The fingerprint changes whenever rows of the account are added, removed or updated.
+        """
+        return {row[0]: "-".join(str(v) for v in tuple(row)[1:]) for row in con.execute(sql) if row[0]}
+
+    def posts_fingerprint_sql(self):
+        processor = self.processor
+        return f"""
+            SELECT m.username, COUNT(*), MAX(p.rowid), MAX(m.rowid),
+                   MAX(COALESCE(p.updated_at, p.created_at)), MAX(COALESCE(m.updated_at, m.created_at))
+            FROM {processor.posts_tbl} p
+            JOIN {processor.posts_metadata_tbl} m ON p.path = m.path
+            GROUP BY m.username
+        """
+
+    def connections_fingerprint_sql(self):
+        return f"""
+            SELECT user_in_focus, COUNT(*), MAX(rowid), MAX(COALESCE(updated_at, created_at))
+            FROM {self.processor.connections_tbl}
+            GROUP BY user_in_focus
+        """
+
+    def load_posts(self, con, username):
+        processor = self.processor
+        df = pd.read_sql_query(
+            f"""
+            SELECT DISTINCT p.*, m.downloaded_at, m.dir, m.year, m.username AS account
+            FROM {processor.posts_tbl} p
+            JOIN {processor.posts_metadata_tbl} m ON p.path = m.path
+            WHERE m.username = ?
+            """,
+            con, params=(username,)
+        )
+        year_from_timestamp = pd.to_datetime(pd.to_numeric(df["timestamp"], errors="coerce"), unit="s", utc=True).dt.year
+        df["year"] = pd.to_numeric(df["year"], errors="coerce").fillna(year_from_timestamp)
+        return apply_types(df.sort_values(["timestamp", "path"], kind="stable"), POSTS_TYPES)
+
+    def load_connections(self, con, username):
+        df = pd.read_sql_query(
+            f"SELECT *, user_in_focus AS account FROM {self.processor.connections_tbl} WHERE user_in_focus = ?",
+            con, params=(username,)
+        )
+        df["year"] = pd.to_numeric(df["path"].astype("string").str.extract(PATH_YEAR, expand=False), errors="coerce")
+        return apply_types(df.sort_values(["path", "type", "username"], kind="stable"), CONNECTION_TYPES)
+
+    def export_dataset(self, con, name, fingerprint_sql, load, manifest):
+        """
+        Update one partitioned dataset. Returns the number of partitions written.
+        """
+        state = manifest.setdefault(name, {"accounts": {}, "partitions": {}})
+        fingerprints = self.account_fingerprints(con, fingerprint_sql)
+        dataset_dir = os.path.join(self.output_dir, name)
+        written = 0
+
+        for account in sorted(state["accounts"].keys() - fingerprints.keys()):
+            shutil.rmtree(os.path.join(dataset_dir, f"account={account}"), ignore_errors=True)
+            state["partitions"] = {k: v for k, v in state["partitions"].items() if not k.startswith(f"{account}/")}
+            del state["accounts"][account]
+
+        for account, fingerprint in sorted(fingerprints.items()):
+            if state["accounts"].get(account) == fingerprint:
+                continue
+            df = load(con, account)
+            account_dir = os.path.join(dataset_dir, f"account={account}")
+            years = set()
+            for year, partition in df.groupby(df["year"].fillna(0).astype(int), sort=True):
+                key = f"{account}/{year}"
+                years.add(key)
+                partition = partition.drop(columns=["account", "year"])
+                digest = content_hash(partition)
+                path = os.path.join(account_dir, f"year={year}", "part-0.parquet")
+                if state["partitions"].get(key) != digest or not os.path.exists(path):
+                    write_parquet(partition, path)
+                    state["partitions"][key] = digest
+                    written += 1
+            for key in [k for k in state["partitions"] if k.startswith(f"{account}/") and k not in years]:
+                shutil.rmtree(os.path.join(account_dir, f"year={key.split('/')[1]}"), ignore_errors=True)
+                del state["partitions"][key]
+            state["accounts"][account] = fingerprint
+            self.save_manifest(manifest)
+
+        logging.info(f"{name}: {len(fingerprints)} accounts, {len(state['partitions'])} partitions, {written} written")
+        return written
+
+    def export_accounts(self, con, manifest):
+        row = con.execute(f"SELECT COUNT(*), MAX(rowid), MAX(COALESCE(updated_at, created_at)) FROM {self.processor.account_tbl}").fetchone()
+        fingerprint = "-".join(str(v) for v in tuple(row))
+        path = os.path.join(self.output_dir, "accounts.parquet")
+        if manifest.get("accounts") == fingerprint and os.path.exists(path):
+            logging.info("accounts: unchanged")
+            return
+        df = pd.read_sql_query(f"SELECT * FROM {self.processor.account_tbl} ORDER BY username", con)
+        write_parquet(apply_types(df, ACCOUNT_TYPES), path)
+        manifest["accounts"] = fingerprint
+        self.save_manifest(manifest)
+        logging.info(f"accounts: {len(df)} profiles written")
+
+    def remove_output(self):
+        """
+        Delete the datasets and the manifest, but nothing else in the output directory.
+        """
+        for name in OUTPUT_PATHS:
+            path = os.path.join(self.output_dir, name)
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+            elif os.path.exists(path):
+                os.remove(path)
+
+    def run(self, full=False):
+        if pyarrow is None:
+            raise SystemExit("pyarrow not found, needed to write Parquet files.\n  pip install [--user] pyarrow")
+        if full:
+            self.remove_output()
+        os.makedirs(self.output_dir, exist_ok=True)
+        manifest = self.load_manifest()
+
+        con = connect(self.processor.db)
+        with snapshot(con):
+            self.export_accounts(con, manifest)
+            self.export_dataset(con, "posts", self.posts_fingerprint_sql(), self.load_posts, manifest)
+            self.export_dataset(con, "connections", self.connections_fingerprint_sql(), self.load_connections, manifest)
+        con.close()
+        self.save_manifest(manifest)
+        logging.info(f"Analytics export in {self.output_dir}, load with pandas.read_parquet('{self.output_dir}/posts')")
+
+
+def export_analytics(processor, output_dir="analytics", full=False):
+    AnalyticsExporter(processor, output_dir).run(full=full)
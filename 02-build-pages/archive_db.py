@@ -0,0 +1,77 @@
+import os
+import sqlite3
+from contextlib import contextmanager
+
+# tuned for a single large archive DB that is written by one ingest and read by many renderers
+BUSY_TIMEOUT_MS = 30000
+CACHE_SIZE_KB = 64 * 1024
+MMAP_SIZE = 1024 * 1024 * 1024
+
+
+def apply_pragmas(con):
+    con.execute(f"PRAGMA busy_timeout = {BUSY_TIMEOUT_MS}")
+    con.execute(f"PRAGMA cache_size = -{CACHE_SIZE_KB}")
+    con.execute(f"PRAGMA mmap_size = {MMAP_SIZE}")
+    con.execute("PRAGMA temp_store = MEMORY")
+
+
+def enable_wal(db):
+    """
+    Switch a database still in rollback journal mode to WAL. Returns False if that
+    is not possible right now, e.g. on a read-only file system or while it is locked.
+    """
+    try:
+        con = sqlite3.connect(db, timeout=1)
+        try:
+            return con.execute("PRAGMA journal_mode = WAL").fetchone()[0] == "wal"
+        finally:
+            con.close()
+    except sqlite3.OperationalError:
+        return False
+
+
+def is_wal(con):
+    return con.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+
+
+def connect(db, readonly=True):
+    """
+    Open the archive database. Readers get a read-only URI connection, writers
+    switch the database to WAL so readers keep working while an ingest is running.
+    Readers do that switch as well if no writer has done it yet.
+    Rows are returned as sqlite3.Row.
+    """
+    if readonly:
+        probe = sqlite3.connect(f"file:{os.path.abspath(db)}?mode=ro", uri=True, timeout=BUSY_TIMEOUT_MS / 1000)
+        needs_wal = not is_wal(probe)
+        probe.close()
+        if needs_wal:
+            enable_wal(db)
+        con = sqlite3.connect(f"file:{os.path.abspath(db)}?mode=ro", uri=True, timeout=BUSY_TIMEOUT_MS / 1000)
+        apply_pragmas(con)
+        con.execute("PRAGMA query_only = ON")
+    else:
+        con = sqlite3.connect(db, timeout=BUSY_TIMEOUT_MS / 1000)
+        apply_pragmas(con)
+        con.execute("PRAGMA journal_mode = WAL")
+        # in WAL mode NORMAL only risks the last transactions on power loss, never corruption
+        con.execute("PRAGMA synchronous = NORMAL")
+    con.row_factory = sqlite3.Row
+    return con
+
+
+@contextmanager
+def snapshot(con):
+    """
+    Run all queries inside the block against one consistent state of the
+    database, even if an ingest commits in the meantime. Without WAL a long read
+    transaction would lock out writers, so then every query runs on its own.
+    """
+    if not is_wal(con):
+        yield con
+        return
+    con.execute("BEGIN")
+    try:
+        yield con
+    finally:
+        con.execute("COMMIT")
@@ -0,0 +1,361 @@
+import os
+import re
+import glob
+import logging
+import hashlib
+import mimetypes
+import threading
+from collections import OrderedDict
+from email.utils import formatdate, parsedate_to_datetime
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import unquote, urlsplit
+
+from archive_db import connect, snapshot
+from repost_index import find_reposts, image_hashes_fingerprint
+
+CHUNK_SIZE = 64 * 1024
+# the only files below data/ the templates link to; keeps the DB and JSON files private
+MEDIA_EXTENSIONS = (".jpg", ".webp", ".png", ".mp4")
+
+ACCOUNT_PAGE = re.compile(r"^/([^/]+)/(?:index\.html)?$")
+YEAR_PAGE = re.compile(r"^/([^/]+)/(\d{4})\.html$")
+TAGGED_PAGE = re.compile(r"^/([^/]+)/(\d{4})_tagged\.html$")
+HIGHLIGHT_PAGE = re.compile(r"^/([^/]+)/(.+)_highlight\.html$")
+FEED_PAGE = re.compile(r"^/feed/(\d{4})/(\d{2})\.html$")
+STATIC_FILE = re.compile(r"^/static/css/([^/]+\.css)$")
+
+
+class PageCache:
+    """
+    Thread-safe LRU cache of rendered pages, keyed by request path. Every page
+    is stored with the version of the sources it was rendered from and only
+    returned for that version, so a render that finishes after a change can't
+    put a stale page back.
+    """
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.pages = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, version):
+        with self.lock:
+            entry = self.pages.get(key)
+            if entry is None:
+                return None
+            if entry[0] != version:
+                del self.pages[key]
+                return None
+            self.pages.move_to_end(key)
+            return entry[1]
+
+    def put(self, key, page, version):
+        with self.lock:
+            self.pages[key] = (version, page)
+            self.pages.move_to_end(key)
+            while len(self.pages) > self.max_size:
+                self.pages.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.pages.clear()
+
+
+class ArchiveServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, processor, exclude_accounts, cache_size):
+        super().__init__(address, ArchiveRequestHandler)
+        self.processor = processor
+        self.exclude_accounts = set(exclude_accounts)
+        self.cache = PageCache(cache_size)
+        self.media_prefix = "/" + os.path.basename(os.path.normpath(processor.base_directory)) + "/"
+        self.source_mtime = self.get_source_mtime()
+        self.source_lock = threading.Lock()
+        self.reposts_fingerprint = None
+        # counts the swaps of processor.reposts, part of the cache version
+        self.reposts_generation = 0
+        self.reposts_thread = None
+        self.load_reposts()
+
+    def load_reposts(self):
+        """
+        Rebuild the repost links if the image hashes changed since the last build.
+        """
+        while True:
+            con = connect(self.processor.db)
+            try:
+                with snapshot(con):
+                    fingerprint = image_hashes_fingerprint(con)
+                    if fingerprint == self.reposts_fingerprint:
+                        return
+                    reposts = find_reposts(self.processor, con, self.exclude_accounts, feed_months=self.processor.feed_months)
+            finally:
+                con.close()
+            # swapped in one assignment, requests keep using the previous links until then
+            self.processor.reposts = reposts
+            self.reposts_fingerprint = fingerprint
+            self.reposts_generation += 1
+            self.cache.clear()
+            logging.info(f"{len(reposts)} posts with reposts")
+
+    def reload_reposts_in_background(self):
+        """
+        Start load_reposts in a thread unless one is running, so a request never
+        waits for the rebuild.
+        """
+        if self.reposts_thread is not None and self.reposts_thread.is_alive():
+            return
+
+        def run():
+            try:
+                self.load_reposts()
+            except Exception:
+                logging.exception("Could not rebuild repost links")
+
+        self.reposts_thread = threading.Thread(target=run, daemon=True)
+        self.reposts_thread.start()
+
+    def get_source_mtime(self):
+        """
+        Newest modification time of the templates and the database (incl. its WAL file),
+        in nanoseconds, so two writes within the same second are told apart.
+        """
+        sources = glob.glob(os.path.join(self.processor.template_dir, "**", "*.html"), recursive=True)
+        sources += [self.processor.db, f"{self.processor.db}-wal"]
+        mtimes = [os.stat(path).st_mtime_ns for path in sources if os.path.exists(path)]
+        return max(mtimes, default=0)
+
+    def check_sources(self):
+        """
+        Drop all cached pages once a template or the database changed.
+        """
+        mtime = self.get_source_mtime()
+        with self.source_lock:
+            if mtime != self.source_mtime:
+                logging.info("Templates or database changed, clearing page cache")
+                self.cache.clear()
+                self.source_mtime = mtime
+                self.reload_reposts_in_background()
+        return mtime
+
+    def render_page(self, path):
+        """
+        Render the page that the static build would write for `path`.
+        Returns None if there is no such page.
+        """
+        processor = self.processor
+        con = connect(processor.db)
+        try:
+            with snapshot(con):
+                return self.render_page_from(con, path)
+        finally:
+            con.close()
+
+    def render_page_from(self, con, path):
+        processor = self.processor
+        if path in ("/", "/index.html"):
+            accounts = processor.load_accounts(con, processor.account_tbl)
+            accounts = [a for a in accounts if a["username"] not in self.exclude_accounts]
+            accounts_count = processor.load_count_tbl(con)
+            posts_by_month, all_months = processor.get_posts_by_month(con, months=200)
+            return processor.render_index_page(accounts, accounts_count, all_months)
+
+        if match := FEED_PAGE.match(path):
+            key = f"{match[1]}/{match[2]}"
+            posts_by_month, all_months = processor.get_posts_by_month(con, months=processor.feed_months)
+            if key not in posts_by_month:
+                return None
+            return processor.render_feed_month_page(key, posts_by_month, all_months)
+
+        if match := YEAR_PAGE.match(path) or TAGGED_PAGE.match(path):
+            account_name, year = match[1], match[2]
+            if account_name in self.exclude_accounts:
+                return None
+            is_tagged = match.re is TAGGED_PAGE
+            posts_by_year = processor.load_posts_by_year(con, account_name, type="tagged" if is_tagged else "post")
+            years = {str(y): y for y in posts_by_year}
+            if year not in years:
+                return None
+            return processor.render_posts_page(account_name, posts_by_year[years[year]], sorted(posts_by_year.keys()), year=years[year], is_tagged=is_tagged)
+
+        if match := HIGHLIGHT_PAGE.match(path):
+            account_name, dir = match[1], match[2]
+            if account_name in self.exclude_accounts:
+                return None
+            highlight_posts_by_dir = processor.load_posts_by_dir(con, account_name, type="highlight")
+            if dir not in highlight_posts_by_dir:
+                return None
+            return processor.render_posts_page(account_name, highlight_posts_by_dir[dir], highlight_posts_by_dir, dir=dir, is_highlight=True)
+
+        if match := ACCOUNT_PAGE.match(path):
+            account_name = match[1]
+            profile_data = processor.load_profile(con, account_name)
+            if profile_data is None or account_name in self.exclude_accounts:
+                return None
+            return processor.render_account_page(
+                account_name,
+                profile_data,
+                processor.load_posts_by_year(con, account_name, type="post"),
+                processor.load_posts_by_year(con, account_name, type="tagged"),
+                processor.load_posts_by_dir(con, account_name, type="highlight"),
+                processor.load_posts_by_year(con, account_name, type="story")
+            )
+        return None
+
+
+class ArchiveRequestHandler(BaseHTTPRequestHandler):
+    server_version = "InstagramArchive"
+
+    def do_GET(self):
+        self.handle_request(send_body=True)
+
+    def do_HEAD(self):
+        self.handle_request(send_body=False)
+
+    def handle_request(self, send_body):
+        path = unquote(urlsplit(self.path).path)
+
+        if match := STATIC_FILE.match(path):
+            return self.send_file(self.server.processor.static_dir, match[1], send_body)
+        if path.startswith(self.server.media_prefix):
+            return self.send_file(self.server.processor.base_directory, path[len(self.server.media_prefix):], send_body, extensions=MEDIA_EXTENSIONS)
+
+        source_mtime = self.server.check_sources()
+        version = (source_mtime, self.server.reposts_generation)
+        page = self.server.cache.get(path, version)
+        if page is None:
+            html_content = self.server.render_page(path)
+            if html_content is None:
+                return self.send_error(HTTPStatus.NOT_FOUND)
+            body = html_content.encode("utf-8")
+            # Last-Modified only has whole seconds
+            page = (body, f'"{hashlib.sha1(body).hexdigest()}"', source_mtime // 1_000_000_000)
+            self.server.cache.put(path, page, version)
+
+        body, etag, last_modified = page
+        if self.is_not_modified(etag, last_modified):
+            return self.send_not_modified(etag, last_modified)
+
+        self.send_response(HTTPStatus.OK)
+        self.send_header("Content-Type", "text/html; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("ETag", etag)
+        self.send_header("Last-Modified", formatdate(last_modified, usegmt=True))
+        self.send_header("Cache-Control", "no-cache")
+        self.end_headers()
+        if send_body:
+            self.wfile.write(body)
+
+    def send_file(self, root, relative_path, send_body, extensions=None):
+        """
+        Serve a file below `root` (only with one of `extensions` if given),
+        honouring single byte ranges so videos can seek.
+        """
+        root = os.path.realpath(root)
+        file_path = os.path.realpath(os.path.join(root, relative_path))
+        if os.path.commonpath([root, file_path]) != root or not os.path.isfile(file_path):
+            return self.send_error(HTTPStatus.NOT_FOUND)
+        if extensions and not file_path.lower().endswith(extensions):
+            return self.send_error(HTTPStatus.NOT_FOUND)
+
+        stat = os.stat(file_path)
+        size = stat.st_size
+        etag = f'"{stat.st_mtime_ns:x}-{size:x}"'
+        last_modified = int(stat.st_mtime)
+        if self.is_not_modified(etag, last_modified):
+            return self.send_not_modified(etag, last_modified)
+
+        start, end = 0, size - 1
+        status = HTTPStatus.OK
+        byte_range = self.headers.get("Range")
+        if byte_range and self.headers.get("If-Range", etag) == etag:
+            parsed = parse_range(byte_range, size)
+            if parsed is False:
+                self.send_response(HTTPStatus.REQUESTED_RANGE_NOT_SATISFIABLE)
+                self.send_header("Content-Range", f"bytes */{size}")
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            if parsed is not None:
+                start, end = parsed
+                status = HTTPStatus.PARTIAL_CONTENT
+
+        length = end - start + 1
+        self.send_response(status)
+        self.send_header("Content-Type", mimetypes.guess_type(file_path)[0] or "application/octet-stream")
+        self.send_header("Content-Length", str(length))
+        self.send_header("Accept-Ranges", "bytes")
+        self.send_header("ETag", etag)
+        self.send_header("Last-Modified", formatdate(last_modified, usegmt=True))
+        if status == HTTPStatus.PARTIAL_CONTENT:
+            self.send_header("Content-Range", f"bytes {start}-{end}/{size}")
+        self.end_headers()
+        if not send_body:
+            return
+
+        with open(file_path, "rb") as f:
+            f.seek(start)
+            remaining = length
+            while remaining > 0:
+                chunk = f.read(min(CHUNK_SIZE, remaining))
+                if not chunk:
+                    break
+                self.wfile.write(chunk)
+                remaining -= len(chunk)
+
+    def is_not_modified(self, etag, last_modified):
+        if_none_match = self.headers.get("If-None-Match")
+        if if_none_match is not None:
+            return etag in [tag.strip() for tag in if_none_match.split(",")] or if_none_match.strip() == "*"
+        if_modified_since = self.headers.get("If-Modified-Since")
+        if if_modified_since:
+            try:
+                return last_modified <= parsedate_to_datetime(if_modified_since).timestamp()
+            except (TypeError, ValueError):
+                return False
+        return False
+
+    def send_not_modified(self, etag, last_modified):
+        self.send_response(HTTPStatus.NOT_MODIFIED)
+        self.send_header("ETag", etag)
+        self.send_header("Last-Modified", formatdate(last_modified, usegmt=True))
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        logging.info(f"{self.address_string()} {format % args}")
+
+
+def parse_range(header, size):
+    """
+    Parse a single "bytes=" range. Returns (start, end), None to ignore the
+    header (e.g. multiple ranges) or False if the range is not satisfiable.
+    """
+    units, _, ranges = header.partition("=")
+    if units.strip() != "bytes" or "," in ranges:
+        return None
+    first, _, last = ranges.strip().partition("-")
+    try:
+        if not first:
+            suffix = int(last)
+            if suffix <= 0:
+                return False
+            return max(size - suffix, 0), size - 1
+        start = int(first)
+        end = int(last) if last else size - 1
+    except ValueError:
+        return None
+    if start >= size or end < start:
+        return False
+    return start, min(end, size - 1)
+
+
+def serve(processor, exclude_accounts, host="127.0.0.1", port=8000, cache_size=256):
+    server = ArchiveServer((host, port), processor, exclude_accounts, cache_size)
+    logging.info(f"Serving the archive on http://{host}:{port}/ (Ctrl+C to stop)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
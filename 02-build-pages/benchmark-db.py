@@ -0,0 +1,132 @@
+import os
+import time
+import random
+import sqlite3
+import logging
+import tempfile
+import statistics
+from argparse import ArgumentParser
+from multiprocessing import Process, Queue
+
+from archive_db import BUSY_TIMEOUT_MS, connect
+
+logging.basicConfig(level=logging.INFO)
+
+READ_QUERY = """
+    SELECT DISTINCT p.*, m.year
+    FROM archive_files p
+    JOIN archive_files_metadata m ON p.path = m.path
+    WHERE m.username = ? AND p.type = 'post'
+"""
+
+
+def open_connection(db, journal_mode, readonly):
+    """
+    WAL runs use the archive_db factory, the rollback journal runs use plain
+    connections as the scripts did before.
+    """
+    if journal_mode == "wal":
+        return connect(db, readonly=readonly)
+    return sqlite3.connect(db, timeout=BUSY_TIMEOUT_MS / 1000)
+
+
+def reader(db, journal_mode, usernames, seconds, results):
+    con = open_connection(db, journal_mode, readonly=True)
+    latencies, errors = [], 0
+    end = time.monotonic() + seconds
+    while time.monotonic() < end:
+        start = time.monotonic()
+        try:
+            rows = con.execute(READ_QUERY, (random.choice(usernames),)).fetchall()
+            shortcodes = [row[4] for row in rows][:500]
+            con.execute(
+                f"SELECT DISTINCT shortcode, username, type FROM archive_connections WHERE shortcode IN ({','.join('?' for _ in shortcodes)})",
+                shortcodes
+            ).fetchall()
+            latencies.append(time.monotonic() - start)
+        except sqlite3.OperationalError:
+            errors += 1
+    con.close()
+    results.put(("read", latencies, errors))
+
+
+def writer(db, journal_mode, seconds, batch_size, pause, results):
+    con = open_connection(db, journal_mode, readonly=False)
+    latencies, errors = [], 0
+    payload = "x" * 500
+    end = time.monotonic() + seconds
+    while time.monotonic() < end:
+        start = time.monotonic()
+        try:
+            with con:
+                con.executemany(
+                    "INSERT INTO benchmark_writes (created_at, payload) VALUES (?, ?)",
+                    [(time.time(), payload) for _ in range(batch_size)]
+                )
+            latencies.append(time.monotonic() - start)
+        except sqlite3.OperationalError:
+            errors += 1
+        time.sleep(pause)
+    con.close()
+    results.put(("write", latencies, errors))
+
+
+def prepare_copy(source_db, target_db, journal_mode):
+    """
+    Copy the archive DB with the backup API so the benchmark never writes to the real archive.
+    """
+    src = sqlite3.connect(f"file:{os.path.abspath(source_db)}?mode=ro", uri=True)
+    dst = sqlite3.connect(target_db)
+    src.backup(dst)
+    src.close()
+    dst.execute(f"PRAGMA journal_mode = {journal_mode}")
+    dst.execute("CREATE TABLE IF NOT EXISTS benchmark_writes (created_at REAL, payload TEXT)")
+    dst.commit()
+    usernames = [row[0] for row in dst.execute("SELECT DISTINCT username FROM archive_files_metadata")]
+    dst.close()
+    return usernames
+
+
+def run_benchmark(db, journal_mode, readers, seconds, batch_size, pause):
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        bench_db = os.path.join(tmp_dir, "benchmark.sqlite")
+        usernames = prepare_copy(db, bench_db, journal_mode)
+        results = Queue()
+        processes = [Process(target=writer, args=(bench_db, journal_mode, seconds, batch_size, pause, results))]
+        processes += [Process(target=reader, args=(bench_db, journal_mode, usernames, seconds, results)) for _ in range(readers)]
+        for process in processes:
+            process.start()
+        collected = [results.get() for _ in processes]
+        for process in processes:
+            process.join()
+
+    for kind in ["read", "write"]:
+        latencies = [latency for k, lats, _ in collected if k == kind for latency in lats]
+        errors = sum(errors for k, _, errors in collected if k == kind)
+        if not latencies:
+            logging.info(f"{journal_mode:>6} {kind:>5}: no successful operations, {errors} errors")
+            continue
+        p95 = statistics.quantiles(latencies, n=20)[-1] if len(latencies) > 1 else latencies[0]
+        logging.info(
+            f"{journal_mode:>6} {kind:>5}: {len(latencies) / seconds:8.1f} ops/s, "
+            f"median {statistics.median(latencies) * 1000:7.1f} ms, p95 {p95 * 1000:7.1f} ms, "
+            f"max {max(latencies) * 1000:7.1f} ms, {errors} errors"
+        )
+
+
+def main():
+    p = ArgumentParser(description="Compare rollback journal and WAL for concurrent page rendering and ingest.")
+    p.add_argument("--db", default="data/instagram.sqlite")
+    p.add_argument("--readers", type=int, default=4, help="number of reader processes")
+    p.add_argument("--seconds", type=float, default=10)
+    p.add_argument("--batch-size", type=int, default=200, help="rows per write transaction")
+    p.add_argument("--write-pause", type=float, default=0.01, help="seconds between write transactions")
+    args = p.parse_args()
+
+    logging.info(f"{args.readers} readers and 1 writer for {args.seconds}s on a copy of {args.db}")
+    for journal_mode in ["delete", "wal"]:
+        run_benchmark(args.db, journal_mode, args.readers, args.seconds, args.batch_size, args.write_pause)
+
+
+if __name__ == "__main__":
+    main()
@@ -5,11 +5,18 @@ import shutil
 import lzma
 import logging
 import re
-import sqlite3
+from argparse import ArgumentParser
 from datetime import datetime, timedelta
 from jinja2 import Environment, FileSystemLoader, TemplateNotFound
 from collections import defaultdict
 
+from archive_db import connect, snapshot
+from analytics_export import export_analytics
+from archive_server import serve
+from compress_output import compress_output
+from export_archive import export_archive
+from repost_index import ImageHashCache, find_reposts, find_similar_images
+
 logging.basicConfig(level=logging.INFO)
 
 class InstagramProcessor:
@@ -26,6 +33,10 @@ class InstagramProcessor:
         self.posts_metadata_tbl = posts_metadata_tbl
         self.posts_tbl = posts_tbl
         self.connections_tbl = connections_tbl
+        # {post path: [similar posts]}, filled from the image hash cache before rendering
+        self.reposts = {}
+        # months of the feed that are rendered as feed/YYYY/MM.html
+        self.feed_months = 36
 
     def load_accounts(self, con, account_tbl):
         """
@@ -124,6 +135,7 @@ class InstagramProcessor:
             post_dict['tagged_users'] = tagged_dict.get(post['shortcode'], [])
             post_dict['mentioned_users'] = mentioned_dict.get(post['shortcode'], [])
             post_dict['commented_users'] = commented_dict.get(post['shortcode'], [])
+            post_dict['reposts'] = self.reposts.get(post['path'], [])
             post_dict['date'] = datetime.fromtimestamp(post['timestamp']).strftime('%Y-%m-%d')
             post_dict['username'] = post['username']
             post_dicts.append(post_dict)
@@ -154,6 +166,7 @@ class InstagramProcessor:
             post_dict['tagged_users'] = tagged_dict.get(post['shortcode'], [])
             post_dict['mentioned_users'] = mentioned_dict.get(post['shortcode'], [])
             post_dict['commented_users'] = commented_dict.get(post['shortcode'], [])
+            post_dict['reposts'] = self.reposts.get(post['path'], [])
             if year:
                 posts_by_year[year].append(post_dict)
         return posts_by_year
@@ -180,6 +193,7 @@ class InstagramProcessor:
             post_dict['tagged_users'] = tagged_dict.get(post['shortcode'], [])
             post_dict['mentioned_users'] = mentioned_dict.get(post['shortcode'], [])
             post_dict['commented_users'] = commented_dict.get(post['shortcode'], [])
+            post_dict['reposts'] = self.reposts.get(post['path'], [])
             if dir:
                 posts_by_dir[dir].append(post_dict)
         return posts_by_dir
@@ -216,11 +230,29 @@ class InstagramProcessor:
                 commented_dict[row['shortcode']].append(row['username'])
         return tagged_dict, mentioned_dict, commented_dict
     
+    def render_posts_page(self, account_name, posts, all_years, year=None, dir=None, is_tagged=False, is_highlight=False):
+        """
+        Render one year (or highlight) page of an account and return the HTML.
+        """
+        template = self.env.get_template("post.html")
+        sorted_posts = sorted(posts, key=lambda x: x["timestamp"], reverse=True)
+        context = dict(
+            posts=sorted_posts,
+            all_years=all_years,
+            account_name=account_name,
+            css_path="../static/css/styles.css"
+        )
+        if is_highlight:
+            context.update(dir=dir, is_highlight=True)
+        else:
+            context.update(year=year, is_tagged=is_tagged)
+        return template.render(**context)
+
     def generate_post_pages(self, account_name, posts_by_year, tagged_posts_by_year, highlight_posts_by_dir):
         #logging.info("Generating HTML pages...")
 
         try:
-            template = self.env.get_template("post.html")
+            self.env.get_template("post.html")
         except TemplateNotFound:
             logging.error("Template 'post.html' not found in the 'templates' directory.")
             return
@@ -232,17 +264,8 @@ class InstagramProcessor:
         all_years = sorted(posts_by_year.keys())
         
         for year, posts in posts_by_year.items():
-            sorted_posts = sorted(posts, key=lambda x: x["timestamp"], reverse=True)
             #logging.info(f"Generating page for {year} ({len(posts)} posts)")
-
-            html_content = template.render(
-                year=year,
-                posts=sorted_posts,
-                all_years=all_years,
-                account_name=account_name,
-                is_tagged=False,
-                css_path="../static/css/styles.css"
-            )
+            html_content = self.render_posts_page(account_name, posts, all_years, year=year)
 
             output_path = os.path.join(account_output_dir, f"{year}.html")
             self.write_to_file(output_path, html_content)
@@ -251,84 +274,75 @@ class InstagramProcessor:
         # create tagged posts HTML pages for each year
         tagged_all_years = sorted(tagged_posts_by_year.keys())
         for year, posts in tagged_posts_by_year.items():
-            sorted_posts = sorted(posts, key=lambda x: x["timestamp"], reverse=True)
             #logging.info(f"Generating tagged page for {year} ({len(posts)} posts)")
-
-            html_content = template.render(
-                year=year,
-                posts=sorted_posts,
-                all_years=tagged_all_years,
-                account_name=account_name,
-                is_tagged=True,
-                css_path="../static/css/styles.css"
-            )
+            html_content = self.render_posts_page(account_name, posts, tagged_all_years, year=year, is_tagged=True)
 
             output_path = os.path.join(account_output_dir, f"{year}_tagged.html")
             self.write_to_file(output_path, html_content)
             #logging.info(f"Saved {output_path}")
 
         for dir, posts in highlight_posts_by_dir.items():
-            sorted_posts = sorted(posts, key=lambda x: x["timestamp"], reverse=True)
             #logging.info(f"Generating highlight page for {dir} ({len(posts)} posts)")
-
-            html_content = template.render(
-                dir=dir,
-                posts=sorted_posts,
-                all_years=highlight_posts_by_dir,
-                account_name=account_name,
-                is_highlight=True,
-                css_path="../static/css/styles.css"
-            )
+            html_content = self.render_posts_page(account_name, posts, highlight_posts_by_dir, dir=dir, is_highlight=True)
 
             output_path = os.path.join(account_output_dir, f"{dir}_highlight.html")
             self.write_to_file(output_path, html_content)
             #logging.info(f"Saved {output_path}")
 
+    def render_account_page(self, account_name, profile, all_years, tagged_all_years, highlight_posts_by_dir, story_posts_by_year):
+        """
+        Render the overview page of an account and return the HTML.
+        """
+        template = self.env.get_template("account.html")
+        return template.render(
+            account_name=account_name,
+            profile=profile,
+            profile_img = self.find_profile_image(account_name),
+            all_years=all_years,
+            tagged_all_years=tagged_all_years,
+            highlight_posts_by_dir = highlight_posts_by_dir,
+            story_posts_by_year = story_posts_by_year,
+            css_path="../static/css/styles.css"
+        )
+
     def generate_account_page(self, account_name, profile, all_years, tagged_all_years, highlight_posts_by_dir, story_posts_by_year):
         #logging.info(f"Generating account page... for {account_name}")
 
         try:
-            template = self.env.get_template("account.html")
+            html_content = self.render_account_page(account_name, profile, all_years, tagged_all_years, highlight_posts_by_dir, story_posts_by_year)
         except TemplateNotFound:
             logging.error("Template 'account.html' not found in the 'templates' directory.")
             return
 
         account_output_dir = os.path.join(self.base_output_dir, account_name)
         os.makedirs(account_output_dir, exist_ok=True)
-        
-        html_content = template.render(
-            account_name=account_name,
-            profile=profile,
-            profile_img = self.find_profile_image(account_name),
-            all_years=all_years,
-            tagged_all_years=tagged_all_years,
-            highlight_posts_by_dir = highlight_posts_by_dir,
-            story_posts_by_year = story_posts_by_year,
-            css_path="../static/css/styles.css"
-        )
 
         output_path = os.path.join(account_output_dir, "index.html")
         self.write_to_file(output_path, html_content)
         #logging.info(f"Saved {output_path}")
 
+    def render_index_page(self, accounts, accounts_count, all_months):
+        """
+        Render the start page listing all accounts and return the HTML.
+        """
+        template = self.env.get_template("index.html")
+        accounts = sorted(accounts, key=lambda a: a["username"].lower())
+        return template.render(
+            accounts=accounts,
+            counts=accounts_count,
+            all_months=all_months,
+            css_path="static/css/styles.css"
+        )
+
     def generate_index_page(self, accounts, accounts_count, all_months):
         logging.info("\nGenerating index page...")
 
         try:
-            template = self.env.get_template("index.html")
+            html_content = self.render_index_page(accounts, accounts_count, all_months)
         except TemplateNotFound:
             logging.error("Template 'index.html' not found in the 'templates' directory.")
             return
 
-        accounts = sorted(accounts, key=lambda a: a["username"].lower())
-
-        html_content = template.render(
-            accounts=accounts,
-            counts=accounts_count,
-            all_months=all_months,
-            css_path="static/css/styles.css"
-        )
-
         output_path = os.path.join(self.base_output_dir, "index.html")
         self.write_to_file(output_path, html_content)
         #logging.info(f"Saved {output_path}")
@@ -348,25 +362,32 @@ class InstagramProcessor:
         all_months = sorted(posts_by_month.keys(), reverse=True)
         return posts_by_month, all_months
 
+    def render_feed_month_page(self, key, posts_by_month, all_months):
+        """
+        Render the feed page of one month ("YYYY/MM") and return the HTML.
+        """
+        year, month = key.split("/")
+        idx = all_months.index(key)
+        prev_key = all_months[idx + 1] if idx + 1 < len(all_months) else None
+        next_key = all_months[idx - 1] if idx > 0 else None
+
+        template = self.env.get_template("feed_month.html")
+        return template.render(
+            posts=posts_by_month[key],
+            year=year,
+            month=month,
+            prev_key=prev_key,
+            next_key=next_key,
+            all_months=all_months,
+            css_path="../../static/css/styles.css"
+        )
+
     def generate_monthly_feed_pages(self, con):
-        posts_by_month, all_months = self.get_posts_by_month(con, months=36)
+        posts_by_month, all_months = self.get_posts_by_month(con, months=self.feed_months)
 
-        for idx, key in enumerate(all_months):
+        for key in all_months:
             year, month = key.split("/")
-            posts = posts_by_month[key]
-            prev_key = all_months[idx + 1] if idx + 1 < len(all_months) else None
-            next_key = all_months[idx - 1] if idx > 0 else None
-
-            template = self.env.get_template("feed_month.html")
-            html_content = template.render(
-                posts=posts,
-                year=year,
-                month=month,
-                prev_key=prev_key,
-                next_key=next_key,
-                all_months=all_months,
-                css_path="../../static/css/styles.css"
-            )
+            html_content = self.render_feed_month_page(key, posts_by_month, all_months)
             output_path = os.path.join(self.base_output_dir, "feed", year, f"{month}.html")
             os.makedirs(os.path.dirname(output_path), exist_ok=True)
             self.write_to_file(output_path, html_content)
@@ -385,8 +406,11 @@ class InstagramProcessor:
         with open(path, "w", encoding="utf-8") as f:
             f.write(content)
     
-def main():
-    processor = InstagramProcessor(
+EXCLUDE_ACCOUNTS = ["andreagibson", "adrian_krenn", "misc", "test"]
+
+
+def create_processor():
+    return InstagramProcessor(
         base_directory="data",
         base_output_dir="instagram-archiv",
         template_dir="templates",
@@ -398,14 +422,32 @@ def main():
         connections_tbl = "archive_connections"
     )
 
+
+def build(processor, hash_images=False):
     logging.info("Instagram JSON to HTML Processor")
     logging.info("=" * 30)
 
-    con = sqlite3.connect(processor.db)
-    con.row_factory = sqlite3.Row
+    if hash_images:
+        update_image_hashes(processor)
+    con = connect(processor.db)
+    # read one consistent state of the DB even if an ingest is writing meanwhile
+    with snapshot(con):
+        render_all_pages(processor, con)
+    logging.info(f"Files are in the {processor.base_output_dir} directory")
+    con.close()
+
+
+def update_image_hashes(processor, workers=None):
+    cache = ImageHashCache(processor.base_directory, processor.db)
+    cache.update(workers=workers)
+    cache.close()
+
+
+def render_all_pages(processor, con):
+    processor.reposts = find_reposts(processor, con, EXCLUDE_ACCOUNTS, feed_months=processor.feed_months)
+    logging.info(f"{len(processor.reposts)} posts with reposts")
     accounts = processor.load_accounts(con, processor.account_tbl)
-    exclude_accounts = ["andreagibson", "adrian_krenn", "misc", "test"]
-    accounts = [a for a in accounts if a["username"] not in exclude_accounts]
+    accounts = [a for a in accounts if a["username"] not in EXCLUDE_ACCOUNTS]
     accounts_count = processor.load_count_tbl(con)
 
     #accounts = ["niederbayerische_division"]#, "sportimsueden23", "1schulztim"] 
@@ -415,7 +457,7 @@ def main():
     processor.generate_index_page(accounts, accounts_count, all_months)
 
     for account in accounts:
-        if account not in exclude_accounts:
+        if account not in EXCLUDE_ACCOUNTS:
             logging.info(f"Processing account: {account["username"]}")
             
             profile_data = processor.load_profile(con, account["username"])
@@ -432,8 +474,58 @@ def main():
 
     processor.generate_monthly_feed_pages(con)
     processor.copy_static_files()
-    logging.info(f"Files are in the {processor.base_output_dir} directory")
-    con.close()
+
+
+def main():
+    p = ArgumentParser(description="Build the static Instagram archive from the SQLite database.")
+    commands = p.add_subparsers(dest="command")
+    build_parser = commands.add_parser("build", help="render all pages into the output directory (default)")
+    build_parser.add_argument("--compress", action="store_true", help="write .gz/.br sidecars after building")
+    build_parser.add_argument("--workers", type=int, default=None, help="number of compression processes")
+    build_parser.add_argument("--hash-images", action="store_true", help="update the image hashes used to link reposts before building")
+    compress_parser = commands.add_parser("compress", help="write .gz/.br sidecars for an existing build")
+    compress_parser.add_argument("--workers", type=int, default=None, help="number of compression processes")
+    export_parser = commands.add_parser("export", help="export a self-contained copy of the archive incl. referenced media")
+    export_target = export_parser.add_mutually_exclusive_group(required=True)
+    export_target.add_argument("--output-dir", help="directory to write the export to")
+    export_target.add_argument("--bundle", help="write a single .zip, .tar or .tar.gz file instead (- for a zip on stdout)")
+    export_parser.add_argument("--account", action="append", dest="accounts", help="only export this account (repeatable)")
+    export_parser.add_argument("--since", help="only posts on or after this date (YYYY-MM-DD)")
+    export_parser.add_argument("--until", help="only posts on or before this date (YYYY-MM-DD)")
+    export_parser.add_argument("--link-mode", choices=["auto", "reflink", "hardlink", "copy"], default="auto", help="how media is placed in --output-dir")
+    analytics_parser = commands.add_parser("analytics", help="export posts, profiles and connections as partitioned Parquet files")
+    analytics_parser.add_argument("--output-dir", default="analytics")
+    analytics_parser.add_argument("--full", action="store_true", help="rewrite everything instead of only changed partitions")
+    hash_parser = commands.add_parser("hash-images", help="update the perceptual hashes used to link reposts")
+    hash_parser.add_argument("--workers", type=int, default=None, help="number of hashing threads")
+    hash_parser.add_argument("--similar", metavar="IMAGE", help="afterwards list the images similar to this one")
+    hash_parser.add_argument("--max-distance", type=int, default=8, help="bits in which similar images may differ")
+    serve_parser = commands.add_parser("serve", help="render pages on request for previewing template changes")
+    serve_parser.add_argument("--host", default="127.0.0.1")
+    serve_parser.add_argument("--port", type=int, default=8000)
+    serve_parser.add_argument("--cache-size", type=int, default=256, help="number of rendered pages kept in memory")
+    args = p.parse_args()
+
+    processor = create_processor()
+    if args.command == "serve":
+        serve(processor, EXCLUDE_ACCOUNTS, host=args.host, port=args.port, cache_size=args.cache_size)
+    elif args.command == "export":
+        export_archive(processor, EXCLUDE_ACCOUNTS, output_dir=args.output_dir, bundle=args.bundle, accounts=args.accounts, since=args.since, until=args.until, link_mode=args.link_mode)
+    elif args.command == "analytics":
+        export_analytics(processor, output_dir=args.output_dir, full=args.full)
+    elif args.command == "hash-images":
+        update_image_hashes(processor, workers=args.workers)
+        if args.similar:
+            con = connect(processor.db)
+            for distance, path in find_similar_images(con, args.similar, args.max_distance):
+                print(f"{distance:2d} {path}")
+            con.close()
+    elif args.command == "compress":
+        compress_output(processor.base_output_dir, workers=args.workers)
+    else:
+        build(processor, hash_images=getattr(args, "hash_images", False))
+        if getattr(args, "compress", False):
+            compress_output(processor.base_output_dir, workers=args.workers)
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
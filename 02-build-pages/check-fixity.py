@@ -0,0 +1,264 @@
+import os
+import re
+import csv
+import mmap
+import time
+import sqlite3
+import hashlib
+import logging
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
+
+from archive_db import connect
+
+logging.basicConfig(level=logging.INFO)
+
+MEDIA_EXTENSIONS = (".jpg", ".jpeg", ".webp", ".png", ".mp4")
+JSON_EXTENSIONS = (".json", ".json.xz")
+# strips "_1.jpg", ".json.xz", "_comments.json" ... to get the name of the post a file belongs to
+POST_SUFFIX = re.compile(r"(_comments)?(_\d+)?\.(jpe?g|webp|png|mp4|json|json\.xz)$")
+COMMIT_EVERY = 500
+
+
+def hash_file(path):
+    """
+    SHA-256 of a file, read through a memory map so large videos are not copied into memory.
+    """
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size > 0:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                sha256.update(m)
+    return sha256.hexdigest()
+
+
+def try_hash_file(path):
+    """
+    Returns (sha256, None), or (None, status) if the file disappeared or cannot be
+    read, e.g. because a crawl is changing the data directory meanwhile.
+    """
+    try:
+        return hash_file(path), None
+    except FileNotFoundError:
+        return None, "missing"
+    except OSError as e:
+        logging.warning(f"Could not read {path}: {e}")
+        return None, "unreadable"
+
+
+class FixityChecker:
+    def __init__(self, base_directory, db, files_tbl="archive_files", fixity_tbl="archive_fixity", runs_tbl="archive_fixity_runs"):
+        self.base_directory = base_directory
+        self.db = db
+        self.files_tbl = files_tbl
+        self.fixity_tbl = fixity_tbl
+        self.runs_tbl = runs_tbl
+        self.con = connect(db, readonly=False)
+        self.create_tables()
+
+    def create_tables(self):
+        self.con.executescript(f"""
+            CREATE TABLE IF NOT EXISTS {self.fixity_tbl} (
+                path TEXT PRIMARY KEY,
+                size INTEGER,
+                mtime_ns INTEGER,
+                sha256 TEXT,
+                first_seen REAL,
+                last_verified REAL,
+                status TEXT
+            );
+            CREATE INDEX IF NOT EXISTS {self.fixity_tbl}_last_verified ON {self.fixity_tbl} (last_verified);
+            CREATE TABLE IF NOT EXISTS {self.runs_tbl} (
+                run_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                started_at REAL,
+                finished_at REAL,
+                state TEXT,
+                hashed INTEGER DEFAULT 0,
+                new INTEGER DEFAULT 0,
+                changed INTEGER DEFAULT 0,
+                missing INTEGER DEFAULT 0
+            );
+        """)
+        self.con.commit()
+
+    def find_files(self):
+        """
+        Returns {path: os.stat_result} for all media and JSON files below the data directory.
+        """
+        files = {}
+        for root, _, filenames in os.walk(self.base_directory):
+            for f in filenames:
+                if f.endswith(MEDIA_EXTENSIONS) or f.endswith(JSON_EXTENSIONS):
+                    path = os.path.join(root, f)
+                    try:
+                        files[path] = os.stat(path)
+                    except OSError:
+                        # dangling symlink or deleted meanwhile, recorded files count as missing
+                        continue
+        return files
+
+    def start_run(self):
+        """
+        Continue an interrupted run or start a new one. Returns (run_id, started_at).
+        """
+        row = self.con.execute(f"SELECT run_id, started_at FROM {self.runs_tbl} WHERE state = 'running' ORDER BY run_id DESC LIMIT 1").fetchone()
+        if row:
+            logging.info(f"Resuming fixity run {row['run_id']} started at {time.ctime(row['started_at'])}")
+            return row["run_id"], row["started_at"]
+        started_at = time.time()
+        cursor = self.con.execute(f"INSERT INTO {self.runs_tbl} (started_at, state) VALUES (?, 'running')", (started_at,))
+        self.con.commit()
+        return cursor.lastrowid, started_at
+
+    def plan_run(self, files, started_at, sample_size):
+        """
+        Pick the files to hash in this run: new files, files whose size or mtime
+        changed and the `sample_size` files that were verified longest ago.
+        Files already verified by an interrupted run are skipped.
+        """
+        known = {row["path"]: row for row in self.con.execute(f"SELECT * FROM {self.fixity_tbl}")}
+        todo = []
+        for path, stat in files.items():
+            row = known.get(path)
+            if row is None or row["size"] != stat.st_size or row["mtime_ns"] != stat.st_mtime_ns or row["status"] != "ok":
+                if row is None or row["last_verified"] < started_at:
+                    todo.append(path)
+
+        todo_set = set(todo)
+        # on resume, files sampled before the interruption count towards the sample
+        sample_size -= self.con.execute(
+            f"SELECT COUNT(*) FROM {self.fixity_tbl} WHERE last_verified >= ? AND first_seen < ?", (started_at, started_at)
+        ).fetchone()[0]
+        sample_size = max(sample_size, 0)
+        sample = self.con.execute(
+            f"SELECT path FROM {self.fixity_tbl} WHERE last_verified < ? AND status = 'ok' ORDER BY last_verified LIMIT ?",
+            (started_at, sample_size + len(todo_set))
+        ).fetchall()
+        sampled = [row["path"] for row in sample if row["path"] in files and row["path"] not in todo_set][:sample_size]
+        missing = [path for path in known if path not in files and known[path]["status"] != "missing"]
+        return known, todo + sampled, missing
+
+    def run(self, sample_size=1000, workers=8, rebaseline=False):
+        run_id, started_at = self.start_run()
+        files = self.find_files()
+        known, todo, missing = self.plan_run(files, started_at, sample_size)
+        logging.info(f"{len(files)} files on disk, {len(known)} recorded, hashing {len(todo)}")
+
+        counts = dict(self.con.execute(f"SELECT hashed, new, changed, missing FROM {self.runs_tbl} WHERE run_id = ?", (run_id,)).fetchone())
+        for path in missing:
+            self.con.execute(f"UPDATE {self.fixity_tbl} SET status = 'missing', last_verified = ? WHERE path = ?", (time.time(), path))
+            counts["missing"] += 1
+
+        unreadable = 0
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for path, (sha256, error) in zip(todo, executor.map(try_hash_file, todo)):
+                stat = files[path]
+                row = known.get(path)
+                now = time.time()
+                if error is not None:
+                    if row is not None:
+                        self.con.execute(f"UPDATE {self.fixity_tbl} SET last_verified = ?, status = ? WHERE path = ?", (now, error, path))
+                    elif error == "unreadable":
+                        self.con.execute(
+                            f"INSERT INTO {self.fixity_tbl} (path, size, mtime_ns, first_seen, last_verified, status) VALUES (?, ?, ?, ?, ?, ?)",
+                            (path, stat.st_size, stat.st_mtime_ns, now, now, error)
+                        )
+                    if error == "missing":
+                        counts["missing"] += row is not None
+                    else:
+                        unreadable += 1
+                elif row is None:
+                    self.con.execute(
+                        f"INSERT INTO {self.fixity_tbl} (path, size, mtime_ns, sha256, first_seen, last_verified, status) VALUES (?, ?, ?, ?, ?, ?, 'ok')",
+                        (path, stat.st_size, stat.st_mtime_ns, sha256, now, now)
+                    )
+                    counts["new"] += 1
+                elif sha256 == row["sha256"] or rebaseline:
+                    self.con.execute(
+                        f"UPDATE {self.fixity_tbl} SET size = ?, mtime_ns = ?, sha256 = ?, last_verified = ?, status = 'ok' WHERE path = ?",
+                        (stat.st_size, stat.st_mtime_ns, sha256, now, path)
+                    )
+                else:
+                    # keep the recorded checksum so the damage stays visible until it is re-baselined
+                    self.con.execute(f"UPDATE {self.fixity_tbl} SET last_verified = ?, status = 'changed' WHERE path = ?", (now, path))
+                    counts["changed"] += 1
+                    logging.warning(f"Checksum mismatch: {path}")
+                counts["hashed"] += 1
+                if counts["hashed"] % COMMIT_EVERY == 0:
+                    self.save_counts(run_id, counts)
+                    logging.info(f"Hashed {counts['hashed']} files")
+
+        self.save_counts(run_id, counts, finished=True)
+        logging.info(f"Fixity run {run_id} finished: {counts}" + (f", {unreadable} unreadable" if unreadable else ""))
+        return counts
+
+    def save_counts(self, run_id, counts, finished=False):
+        """
+        Store the progress of the run and commit, so an interrupted run can resume from here.
+        """
+        self.con.execute(
+            f"UPDATE {self.runs_tbl} SET hashed = ?, new = ?, changed = ?, missing = ? WHERE run_id = ?",
+            (counts["hashed"], counts["new"], counts["changed"], counts["missing"], run_id)
+        )
+        if finished:
+            self.con.execute(f"UPDATE {self.runs_tbl} SET state = 'finished', finished_at = ? WHERE run_id = ?", (time.time(), run_id))
+        self.con.commit()
+
+    def report(self):
+        """
+        Returns a list of (status, path, detail) rows: files whose checksum changed
+        or that disappeared, posts in archive_files without a file on disk and files
+        on disk that belong to no post in archive_files.
+        """
+        rows = []
+        for row in self.con.execute(f"SELECT path, status, sha256 FROM {self.fixity_tbl} WHERE status != 'ok' ORDER BY path"):
+            rows.append((row["status"], row["path"], f"recorded sha256 {row['sha256']}"))
+
+        try:
+            post_paths = {row[0] for row in self.con.execute(f"SELECT DISTINCT path FROM {self.files_tbl}")}
+        except sqlite3.OperationalError:
+            logging.warning(f"Table {self.files_tbl} not found, skipping the cross-check")
+            return rows
+
+        recorded = {row[0] for row in self.con.execute(f"SELECT path FROM {self.fixity_tbl} WHERE status != 'missing'")}
+        post_bases = {POST_SUFFIX.sub("", path) for path in post_paths}
+        for path in sorted(post_paths):
+            if not os.path.exists(path):
+                rows.append(("missing", path, f"listed in {self.files_tbl}"))
+        for path in sorted(recorded):
+            # files directly in an account directory (profile pictures, profile JSON) belong to no post
+            if os.path.dirname(os.path.dirname(path)) == os.path.normpath(self.base_directory):
+                continue
+            if POST_SUFFIX.sub("", path) not in post_bases:
+                rows.append(("orphaned", path, f"no post in {self.files_tbl}"))
+        return rows
+
+    def write_report(self, rows, report_path):
+        with open(report_path, "w", encoding="utf-8", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(["status", "path", "detail"])
+            writer.writerows(rows)
+
+
+def main():
+    p = ArgumentParser(description="Record and verify checksums of the archived media and JSON files.")
+    p.add_argument("--data-dir", default="data")
+    p.add_argument("--db", default="data/instagram.sqlite")
+    p.add_argument("--sample-size", type=int, default=1000, help="number of already verified files to re-check per run")
+    p.add_argument("--workers", type=int, default=8, help="number of hashing threads")
+    p.add_argument("--report", default="fixity-report.csv", help="CSV file listing missing, changed and orphaned files")
+    p.add_argument("--rebaseline", action="store_true", help="accept the current content of changed files as correct")
+    args = p.parse_args()
+
+    checker = FixityChecker(args.data_dir, args.db)
+    checker.run(sample_size=args.sample_size, workers=args.workers, rebaseline=args.rebaseline)
+    rows = checker.report()
+    checker.write_report(rows, args.report)
+    for status in ["missing", "changed", "orphaned"]:
+        logging.info(f"{status}: {sum(1 for row in rows if row[0] == status)}")
+    logging.info(f"Report written to {args.report}")
+    checker.con.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,148 @@
+import os
+import gzip
+import json
+import hashlib
+import logging
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+
+try:
+    import brotli
+except ModuleNotFoundError:
+    brotli = None
+
+COMPRESS_EXTENSIONS = (".html", ".css", ".js", ".json")
+SIDECAR_EXTENSIONS = (".gz", ".br")
+MANIFEST_FILE = ".compress-manifest.json"
+
+
+def find_compressible_files(output_dir):
+    files = []
+    for root, _, filenames in os.walk(output_dir):
+        for f in filenames:
+            if f.endswith(COMPRESS_EXTENSIONS) and f != MANIFEST_FILE:
+                files.append(os.path.join(root, f))
+    return sorted(files)
+
+
+def write_sidecar(path, data):
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
+def sidecar_size(path):
+    return os.path.getsize(path) if os.path.exists(path) else 0
+
+
+def compress_file(path, known_hash):
+    """
+    Write `path`.gz (and `path`.br if brotli is installed) unless the content
+    hash matches `known_hash` and the sidecars already exist.
+    Returns (path, content hash, raw size, gzip size, brotli size, compressed?).
+    """
+    with open(path, "rb") as f:
+        data = f.read()
+    content_hash = hashlib.sha256(data).hexdigest()
+    gz_path, br_path = f"{path}.gz", f"{path}.br"
+
+    up_to_date = content_hash == known_hash and os.path.exists(gz_path) and (brotli is None or os.path.exists(br_path))
+    if not up_to_date:
+        # mtime=0 keeps the gzip output identical for identical input
+        write_sidecar(gz_path, gzip.compress(data, compresslevel=9, mtime=0))
+        if brotli is not None:
+            write_sidecar(br_path, brotli.compress(data, quality=11))
+        elif os.path.exists(br_path):
+            # a .br from a run with brotli would otherwise keep serving the old content
+            os.remove(br_path)
+
+    return path, content_hash, len(data), sidecar_size(gz_path), sidecar_size(br_path), not up_to_date
+
+
+def remove_orphaned_sidecars(output_dir):
+    """
+    Delete .gz/.br sidecars whose source file no longer exists. Returns how many.
+    """
+    removed = 0
+    for root, _, filenames in os.walk(output_dir):
+        for f in filenames:
+            source, ext = os.path.splitext(f)
+            if ext in SIDECAR_EXTENSIONS and source.endswith(COMPRESS_EXTENSIONS) and not os.path.exists(os.path.join(root, source)):
+                os.remove(os.path.join(root, f))
+                removed += 1
+    return removed
+
+
+def load_manifest(output_dir):
+    try:
+        with open(os.path.join(output_dir, MANIFEST_FILE), "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+
+def save_manifest(output_dir, manifest):
+    with open(os.path.join(output_dir, MANIFEST_FILE), "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=0, sort_keys=True)
+
+
+def compress_output(output_dir, workers=None):
+    """
+    Pre-compress all HTML, CSS and index files of the static build in parallel
+    so the web server can hand out the sidecars instead of compressing on the fly.
+    """
+    if not os.path.isdir(output_dir):
+        raise SystemExit(f"Output directory {output_dir} not found, run build first.")
+    if brotli is None:
+        logging.info("brotli not installed, writing only .gz sidecars")
+
+    manifest = load_manifest(output_dir)
+    files = find_compressible_files(output_dir)
+    new_manifest = {}
+    sizes = defaultdict(lambda: [0, 0, 0, 0])
+    compressed_files = 0
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        relative_paths = [os.path.relpath(path, output_dir) for path in files]
+        known_hashes = [manifest.get(rel) for rel in relative_paths]
+        results = executor.map(compress_file, files, known_hashes, chunksize=64)
+        for rel, (path, content_hash, raw_size, gz_size, br_size, compressed) in zip(relative_paths, results):
+            new_manifest[rel] = content_hash
+            compressed_files += compressed
+            ext_sizes = sizes[os.path.splitext(path)[1]]
+            ext_sizes[0] += 1
+            ext_sizes[1] += raw_size
+            ext_sizes[2] += gz_size
+            ext_sizes[3] += br_size
+
+    save_manifest(output_dir, new_manifest)
+    removed = remove_orphaned_sidecars(output_dir)
+    if removed:
+        logging.info(f"Removed {removed} sidecars of deleted files")
+    log_size_report(sizes, len(files), compressed_files)
+    return sizes
+
+
+def format_size(num_bytes):
+    for unit in ["B", "KB", "MB", "GB"]:
+        if num_bytes < 1024 or unit == "GB":
+            return f"{num_bytes:.1f} {unit}"
+        num_bytes /= 1024
+
+
+def log_size_report(sizes, total_files, compressed_files):
+    logging.info(f"Compressed {compressed_files} of {total_files} files ({total_files - compressed_files} unchanged)")
+    totals = [0, 0, 0, 0]
+    for ext, ext_sizes in sorted(sizes.items()):
+        totals = [a + b for a, b in zip(totals, ext_sizes)]
+        log_size_line(ext, ext_sizes)
+    log_size_line("total", totals)
+
+
+def log_size_line(label, ext_sizes):
+    files, raw_size, gz_size, br_size = ext_sizes
+    line = f"{label:>6}: {files} files, {format_size(raw_size)} raw, {format_size(gz_size)} gzip ({gz_size / raw_size:.1%})" if raw_size else f"{label:>6}: {files} files"
+    if br_size and raw_size:
+        line += f", {format_size(br_size)} brotli ({br_size / raw_size:.1%})"
+    logging.info(line)
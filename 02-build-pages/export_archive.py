@@ -0,0 +1,306 @@
+import os
+import io
+import sys
+import json
+import glob
+import time
+import errno
+import fcntl
+import shutil
+import logging
+import tarfile
+import zipfile
+from collections import defaultdict
+from datetime import datetime
+
+from archive_db import connect, snapshot
+from repost_index import find_reposts
+
+# ioctl request to clone a file's extents (reflink) on btrfs, xfs, ...
+FICLONE = 0x40049409
+# the export writes the feed pages of all months, not only the recent ones
+EXPORT_FEED_MONTHS = 200
+# files written by the last export into a directory, so a re-export can remove what it no longer writes
+MANIFEST_FILE = ".export-manifest.json"
+
+
+def reflink(src, dst):
+    with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+        try:
+            fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+        except OSError:
+            fdst.close()
+            os.remove(dst)
+            raise
+
+
+def is_up_to_date(src, dst):
+    """
+    True if `dst` is `src` (hard link) or a copy with the same size and mtime.
+    """
+    if not os.path.exists(dst):
+        return False
+    if os.path.samefile(src, dst):
+        return True
+    src_stat, dst_stat = os.stat(src), os.stat(dst)
+    return (src_stat.st_size, src_stat.st_mtime_ns) == (dst_stat.st_size, dst_stat.st_mtime_ns)
+
+
+def place_file(src, dst, link_mode="auto"):
+    """
+    Put `src` at `dst` using a reflink or hard link if possible, a copy otherwise.
+    Returns the method that was used.
+    """
+    if is_up_to_date(src, dst):
+        return "existing"
+    os.makedirs(os.path.dirname(dst), exist_ok=True)
+    if os.path.exists(dst):
+        os.remove(dst)
+
+    methods = {"auto": ["reflink", "hardlink"], "reflink": ["reflink"], "hardlink": ["hardlink"], "copy": []}[link_mode]
+    for method in methods:
+        try:
+            if method == "reflink":
+                reflink(src, dst)
+                # like copy2, so the next export sees the clone as up to date
+                shutil.copystat(src, dst)
+            else:
+                os.link(src, dst)
+            return method
+        except OSError as e:
+            if e.errno not in (errno.EXDEV, errno.EOPNOTSUPP, errno.ENOTTY, errno.EINVAL, errno.EPERM, errno.EMLINK):
+                raise
+    shutil.copy2(src, dst)
+    return "copy"
+
+
+class DirectoryTarget:
+    """
+    Writes the export as a plain directory tree. Files an earlier export wrote
+    that this one doesn't (e.g. after narrowing --account or --since) are removed;
+    other files in the directory are left alone.
+    """
+    def __init__(self, output_dir, link_mode="auto"):
+        self.output_dir = output_dir
+        self.link_mode = link_mode
+        self.placed = defaultdict(int)
+        self.written = set()
+
+    def add_page(self, arcname, content):
+        path = os.path.join(self.output_dir, arcname)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(content)
+        self.written.add(arcname)
+
+    def add_file(self, src, arcname):
+        self.placed[place_file(src, os.path.join(self.output_dir, arcname), self.link_mode)] += 1
+        self.written.add(arcname)
+
+    def remove_stale_files(self):
+        manifest_path = os.path.join(self.output_dir, MANIFEST_FILE)
+        try:
+            with open(manifest_path, encoding="utf-8") as f:
+                previous = set(json.load(f))
+        except (FileNotFoundError, json.JSONDecodeError):
+            previous = set()
+
+        removed = 0
+        for arcname in sorted(previous - self.written):
+            path = os.path.join(self.output_dir, arcname)
+            if os.path.isfile(path):
+                os.remove(path)
+                removed += 1
+            # drop directories that became empty, up to the output directory
+            parent = os.path.dirname(path)
+            while os.path.normpath(parent) != os.path.normpath(self.output_dir) and os.path.isdir(parent) and not os.listdir(parent):
+                os.rmdir(parent)
+                parent = os.path.dirname(parent)
+
+        with open(manifest_path, "w", encoding="utf-8") as f:
+            json.dump(sorted(self.written), f, indent=0)
+        return removed
+
+    def close(self):
+        removed = self.remove_stale_files()
+        logging.info(f"Media placed: {dict(self.placed)}, {removed} files of an earlier export removed")
+
+
+class ZipTarget:
+    """
+    Streams the export into a single ZIP file. Pages are deflated, media is
+    stored as is since images and videos are already compressed.
+    """
+    def __init__(self, path):
+        self.file = sys.stdout.buffer if path == "-" else open(path, "wb")
+        self.zip = zipfile.ZipFile(self.file, "w", compression=zipfile.ZIP_DEFLATED, allowZip64=True)
+
+    def add_page(self, arcname, content):
+        self.zip.writestr(arcname, content.encode("utf-8"), compress_type=zipfile.ZIP_DEFLATED)
+
+    def add_file(self, src, arcname):
+        self.zip.write(src, arcname, compress_type=zipfile.ZIP_STORED)
+
+    def close(self):
+        self.zip.close()
+        if self.file is not sys.stdout.buffer:
+            self.file.close()
+
+
+class TarTarget:
+    """
+    Streams the export into a single (optionally gzipped) tar file.
+    """
+    def __init__(self, path):
+        mode = "w|gz" if path.endswith((".tar.gz", ".tgz")) else "w|"
+        self.file = sys.stdout.buffer if path == "-" else open(path, "wb")
+        self.tar = tarfile.open(fileobj=self.file, mode=mode)
+
+    def add_page(self, arcname, content):
+        data = content.encode("utf-8")
+        info = tarfile.TarInfo(arcname)
+        info.size = len(data)
+        info.mtime = int(time.time())
+        self.tar.addfile(info, io.BytesIO(data))
+
+    def add_file(self, src, arcname):
+        self.tar.add(src, arcname, recursive=False)
+
+    def close(self):
+        self.tar.close()
+        if self.file is not sys.stdout.buffer:
+            self.file.close()
+
+
+def open_target(output_dir=None, bundle=None, link_mode="auto"):
+    if bundle is None:
+        return DirectoryTarget(output_dir, link_mode)
+    if bundle.endswith(".zip") or bundle == "-":
+        return ZipTarget(bundle)
+    if bundle.endswith((".tar", ".tar.gz", ".tgz")):
+        return TarTarget(bundle)
+    raise SystemExit(f"Unknown bundle format: {bundle} (use .zip, .tar or .tar.gz)")
+
+
+def parse_date(value):
+    return int(datetime.strptime(value, "%Y-%m-%d").timestamp()) if value else None
+
+
+def in_range(post, since=None, until=None):
+    return (since is None or post["timestamp"] >= since) and (until is None or post["timestamp"] <= until)
+
+
+def filter_posts(posts_by_key, since=None, until=None, usernames=None):
+    """
+    Keep only posts between `since` and `until` (timestamps, inclusive), drop empty
+    groups. Repost links to posts outside the export are dropped as well.
+    """
+    filtered = defaultdict(list)
+    for key, posts in posts_by_key.items():
+        for post in posts:
+            if in_range(post, since, until):
+                if usernames is not None and post.get("reposts"):
+                    post["reposts"] = [r for r in post["reposts"] if r["username"] in usernames and in_range(r, since, until)]
+                filtered[key].append(post)
+    return filtered
+
+
+def export_archive(processor, exclude_accounts, output_dir=None, bundle=None, accounts=None, since=None, until=None, link_mode="auto"):
+    """
+    Export a self-contained copy of the archive: the rendered pages plus only the
+    media they reference, laid out as `<site>/...` and `data/...` so the
+    relative media links in the templates keep working.
+    """
+    site_dir = os.path.basename(os.path.normpath(processor.base_output_dir))
+    since_ts, until_ts = parse_date(since), parse_date(until)
+    # include the whole last day
+    until_ts = until_ts + 86399 if until_ts is not None else None
+
+    con = connect(processor.db)
+    target = open_target(output_dir, bundle, link_mode)
+    with snapshot(con):
+        media, all_accounts = write_pages(processor, con, target, site_dir, exclude_accounts, accounts, since_ts, until_ts)
+    con.close()
+
+    for css_file in glob.glob(os.path.join(processor.static_dir, "*.css")):
+        target.add_file(css_file, f"{site_dir}/static/css/{os.path.basename(css_file)}")
+
+    missing = 0
+    for path in sorted(media):
+        if not os.path.isfile(path):
+            missing += 1
+            continue
+        target.add_file(path, os.path.normpath(path).replace(os.sep, "/"))
+    target.close()
+
+    logging.info(f"Exported {len(all_accounts)} accounts and {len(media) - missing} media files ({missing} missing)")
+
+
+def write_pages(processor, con, target, site_dir, exclude_accounts, accounts, since_ts, until_ts):
+    """
+    Render all pages of the export into `target`. Returns the set of referenced
+    media files and the exported accounts.
+    """
+    media = set()
+
+    all_accounts = processor.load_accounts(con, processor.account_tbl)
+    all_accounts = [a for a in all_accounts if a["username"] not in exclude_accounts]
+    if accounts:
+        all_accounts = [a for a in all_accounts if a["username"] in accounts]
+    usernames = {a["username"] for a in all_accounts}
+    accounts_count = {}
+    processor.reposts = find_reposts(processor, con, exclude_accounts, feed_months=EXPORT_FEED_MONTHS)
+
+    for account in all_accounts:
+        account_name = account["username"]
+        logging.info(f"Exporting account: {account_name}")
+        profile_data = processor.load_profile(con, account_name)
+        posts_by_year = filter_posts(processor.load_posts_by_year(con, account_name, type="post"), since_ts, until_ts, usernames)
+        tagged_posts_by_year = filter_posts(processor.load_posts_by_year(con, account_name, type="tagged"), since_ts, until_ts, usernames)
+        story_posts_by_year = filter_posts(processor.load_posts_by_year(con, account_name, type="story"), since_ts, until_ts, usernames)
+        highlight_posts_by_dir = filter_posts(processor.load_posts_by_dir(con, account_name, type="highlight"), since_ts, until_ts, usernames)
+
+        accounts_count[account_name] = {
+            "post": sum(len(posts) for posts in posts_by_year.values()),
+            "tagged": sum(len(posts) for posts in tagged_posts_by_year.values()),
+            "story": sum(len(posts) for posts in story_posts_by_year.values()),
+            "highlight": sum(len(posts) for posts in highlight_posts_by_dir.values())
+        }
+
+        target.add_page(
+            f"{site_dir}/{account_name}/index.html",
+            processor.render_account_page(account_name, profile_data, posts_by_year, tagged_posts_by_year, highlight_posts_by_dir, story_posts_by_year)
+        )
+        profile_img = processor.find_profile_image(account_name)
+        if profile_img:
+            media.add(profile_img)
+
+        all_years = sorted(posts_by_year.keys())
+        for year, posts in posts_by_year.items():
+            target.add_page(f"{site_dir}/{account_name}/{year}.html", processor.render_posts_page(account_name, posts, all_years, year=year))
+        tagged_all_years = sorted(tagged_posts_by_year.keys())
+        for year, posts in tagged_posts_by_year.items():
+            target.add_page(f"{site_dir}/{account_name}/{year}_tagged.html", processor.render_posts_page(account_name, posts, tagged_all_years, year=year, is_tagged=True))
+        for dir, posts in highlight_posts_by_dir.items():
+            target.add_page(f"{site_dir}/{account_name}/{dir}_highlight.html", processor.render_posts_page(account_name, posts, highlight_posts_by_dir, dir=dir, is_highlight=True))
+
+        for posts_by_key in (posts_by_year, tagged_posts_by_year, highlight_posts_by_dir):
+            for posts in posts_by_key.values():
+                for post in posts:
+                    media.update(post["images"])
+
+    # the feed only lists months that are part of the export, so every link resolves
+    posts_by_month, _ = processor.get_posts_by_month(con, months=EXPORT_FEED_MONTHS)
+    posts_by_month = filter_posts(
+        {key: [p for p in posts if p["username"] in usernames] for key, posts in posts_by_month.items()},
+        since_ts, until_ts, usernames
+    )
+    all_months = sorted(posts_by_month.keys(), reverse=True)
+    for key in all_months:
+        year, month = key.split("/")
+        target.add_page(f"{site_dir}/feed/{year}/{month}.html", processor.render_feed_month_page(key, posts_by_month, all_months))
+        for post in posts_by_month[key]:
+            media.update(post["images"])
+
+    target.add_page(f"{site_dir}/index.html", processor.render_index_page(all_accounts, accounts_count, all_months))
+    return media, all_accounts
@@ -0,0 +1,318 @@
+import os
+import re
+import time
+import hashlib
+import logging
+import sqlite3
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+import numpy as np
+
+try:
+    from PIL import Image
+except ModuleNotFoundError:
+    Image = None
+
+from archive_db import connect
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".webp", ".png")
+# strips "_1.jpg" ... to get the name of the post an image belongs to
+IMAGE_SUFFIX = re.compile(r"(_\d+)?\.(jpe?g|webp|png)$")
+JSON_SUFFIX = re.compile(r"\.json(\.xz)?$")
+HASH_SIZE = 8
+COMMIT_EVERY = 500
+# a common graphic can be in hundreds of posts, only link the earliest ones
+MAX_LINKS = 20
+
+if hasattr(np, "bitwise_count"):
+    popcount = np.bitwise_count
+else:
+    BYTE_POPCOUNT = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+    def popcount(values):
+        values = np.ascontiguousarray(values, dtype=np.uint64)
+        return BYTE_POPCOUNT[values.view(np.uint8)].reshape(values.shape + (8,)).sum(axis=-1)
+
+
+def dhash(path, size=HASH_SIZE):
+    """
+    64 bit difference hash: compares neighbouring pixels of a grayscale thumbnail,
+    so it survives recompression, resizing and small color changes.
+    """
+    with Image.open(path) as img:
+        # lets the JPEG decoder scale down while decoding instead of decoding full size
+        img.draft("L", (size * 8, size * 8))
+        pixels = np.asarray(img.convert("L").resize((size + 1, size), Image.Resampling.BILINEAR), dtype=np.int16)
+    bits = (pixels[:, 1:] > pixels[:, :-1]).flatten()
+    return int.from_bytes(np.packbits(bits).tobytes(), "big")
+
+
+def to_signed(value):
+    """
+    SQLite integers are signed 64 bit.
+    """
+    return value - (1 << 64) if value >= 1 << 63 else value
+
+
+def hash_image(path, known_hashes):
+    """
+    Content hash of an image, plus its dhash unless that content was hashed before.
+    Returns (path, size, mtime_ns, sha256, dhash, computed?).
+    """
+    stat = os.stat(path)
+    with open(path, "rb") as f:
+        sha256 = hashlib.file_digest(f, "sha256").hexdigest()
+    if sha256 in known_hashes:
+        return path, stat.st_size, stat.st_mtime_ns, sha256, None, False
+    try:
+        value = to_signed(dhash(path))
+    except (OSError, ValueError) as e:
+        logging.warning(f"Could not hash {path}: {e}")
+        value = None
+    return path, stat.st_size, stat.st_mtime_ns, sha256, value, True
+
+
+class HammingIndex:
+    """
+    Index over 64 bit hashes. Identical hashes are stored once; `ids[i]` lists
+    what was added for `hashes[i]`.
+    """
+    def __init__(self, hashes, ids):
+        hashes = np.asarray(hashes, dtype=np.uint64)
+        self.hashes, inverse = np.unique(hashes, return_inverse=True)
+        self.ids = [[] for _ in range(len(self.hashes))]
+        for position, id in zip(inverse.tolist(), ids):
+            self.ids[position].append(id)
+
+    def query(self, value, max_distance):
+        """
+        Return [(distance, id)] of everything within `max_distance` bits of `value`,
+        a single vectorized scan over all hashes.
+        """
+        distances = popcount(self.hashes ^ np.uint64(value))
+        matches = np.flatnonzero(distances <= max_distance)
+        return sorted((int(distances[i]), id) for i in matches for id in self.ids[i])
+
+    def pairs(self, max_distance):
+        """
+        Return all pairs of hash positions within `max_distance` bits. The hashes
+        are split into `max_distance + 1` bands; two hashes this close agree on at
+        least one band, so only hashes sharing a band value are compared.
+        """
+        bands = max_distance + 1
+        left, right = [], []
+        shift = 0
+        for band in range(bands):
+            width = 64 // bands + (1 if band < 64 % bands else 0)
+            keys = (self.hashes >> np.uint64(shift)) & np.uint64((1 << width) - 1)
+            shift += width
+            order = np.argsort(keys, kind="stable")
+            bounds = np.flatnonzero(np.diff(keys[order])) + 1
+            starts, ends = np.r_[0, bounds], np.r_[bounds, len(order)]
+            for start, end in zip(starts[ends - starts > 1], ends[ends - starts > 1]):
+                members = order[start:end]
+                values = self.hashes[members]
+                close = np.triu(popcount(values[:, None] ^ values[None, :]) <= max_distance, k=1)
+                i, j = np.nonzero(close)
+                left.append(members[i])
+                right.append(members[j])
+        if not left:
+            return []
+        pairs = np.unique(np.stack([np.concatenate(left), np.concatenate(right)], axis=1), axis=0)
+        return pairs.tolist()
+
+
+class ImageHashCache:
+    """
+    dhash of every image below `base_directory`. Hashes are stored per content
+    (sha256), so an image reposted or downloaded twice is only decoded once;
+    files whose size and mtime did not change are not read again.
+    """
+    def __init__(self, base_directory, db, files_tbl="archive_image_files", hashes_tbl="archive_image_hashes"):
+        self.base_directory = base_directory
+        self.files_tbl = files_tbl
+        self.hashes_tbl = hashes_tbl
+        self.con = connect(db, readonly=False)
+        self.create_tables()
+
+    def create_tables(self):
+        self.con.executescript(f"""
+            CREATE TABLE IF NOT EXISTS {self.files_tbl} (
+                path TEXT PRIMARY KEY,
+                size INTEGER,
+                mtime_ns INTEGER,
+                sha256 TEXT
+            );
+            CREATE TABLE IF NOT EXISTS {self.hashes_tbl} (
+                sha256 TEXT PRIMARY KEY,
+                dhash INTEGER,
+                computed_at REAL
+            );
+        """)
+        self.con.commit()
+
+    def list_images(self):
+        for root, _, files in os.walk(self.base_directory):
+            for name in files:
+                if name.lower().endswith(IMAGE_EXTENSIONS) and "profile_pic" not in name:
+                    yield os.path.join(root, name)
+
+    def update(self, workers=None):
+        if Image is None:
+            raise SystemExit("Pillow not found, needed to hash images.\n  pip install [--user] pillow")
+
+        known_files = {row["path"]: (row["size"], row["mtime_ns"]) for row in self.con.execute(f"SELECT path, size, mtime_ns FROM {self.files_tbl}")}
+        known_hashes = {row["sha256"] for row in self.con.execute(f"SELECT sha256 FROM {self.hashes_tbl}")}
+
+        paths, todo = set(), []
+        for path in self.list_images():
+            paths.add(path)
+            stat = os.stat(path)
+            if known_files.get(path) != (stat.st_size, stat.st_mtime_ns):
+                todo.append(path)
+        removed = [(path,) for path in known_files.keys() - paths]
+        self.con.executemany(f"DELETE FROM {self.files_tbl} WHERE path = ?", removed)
+        logging.info(f"{len(paths)} images, {len(todo)} new or changed, {len(removed)} removed")
+
+        computed = 0
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for done, (path, size, mtime_ns, sha256, value, is_new) in enumerate(executor.map(lambda p: hash_image(p, known_hashes), todo), 1):
+                self.con.execute(f"INSERT OR REPLACE INTO {self.files_tbl} (path, size, mtime_ns, sha256) VALUES (?, ?, ?, ?)", (path, size, mtime_ns, sha256))
+                if is_new:
+                    self.con.execute(f"INSERT OR IGNORE INTO {self.hashes_tbl} (sha256, dhash, computed_at) VALUES (?, ?, ?)", (sha256, value, time.time()))
+                    known_hashes.add(sha256)
+                    computed += 1
+                if done % COMMIT_EVERY == 0:
+                    self.con.commit()
+                    logging.info(f"Hashed {done}/{len(todo)} images")
+        self.con.commit()
+        logging.info(f"Computed {computed} perceptual hashes, reused {len(todo) - computed} by content")
+
+    def close(self):
+        self.con.close()
+
+
+def load_image_hashes(con, files_tbl="archive_image_files", hashes_tbl="archive_image_hashes"):
+    """
+    Returns {image path: dhash} for all hashed images, empty if nothing was hashed yet.
+    """
+    try:
+        rows = con.execute(f"""
+            SELECT f.path, h.dhash
+            FROM {files_tbl} f
+            JOIN {hashes_tbl} h ON f.sha256 = h.sha256
+            WHERE h.dhash IS NOT NULL
+        """).fetchall()
+    except sqlite3.OperationalError:
+        return {}
+    return {row["path"]: row["dhash"] for row in rows}
+
+
+def image_hashes_fingerprint(con, files_tbl="archive_image_files", hashes_tbl="archive_image_hashes"):
+    """
+    Cheap fingerprint of the hash tables, changes whenever images are hashed,
+    replaced or removed. None if nothing was hashed yet.
+    """
+    try:
+        row = con.execute(f"""
+            SELECT (SELECT COUNT(*) FROM {files_tbl}), (SELECT MAX(rowid) FROM {files_tbl}),
+                   (SELECT COUNT(*) FROM {hashes_tbl}), (SELECT MAX(rowid) FROM {hashes_tbl})
+        """).fetchone()
+    except sqlite3.OperationalError:
+        return None
+    return tuple(row)
+
+
+def post_url(post, feed_since=None):
+    """
+    Page of a post relative to the output directory, None for posts without one.
+    Stories are only on the feed pages, so stories before `feed_since` have none.
+    """
+    if post["type"] == "post" and post["year"]:
+        return f"{post['username']}/{post['year']}.html#{post['shortcode']}"
+    if post["type"] == "highlight" and post["dir"]:
+        return f"{post['username']}/{post['dir']}_highlight.html#{post['shortcode']}"
+    if post["type"] == "story" and post["timestamp"] and (feed_since is None or post["timestamp"] >= feed_since):
+        return f"feed/{datetime.fromtimestamp(post['timestamp']).strftime('%Y/%m')}.html#{post['shortcode']}"
+    # tagged posts are other accounts' posts, linked via their own pages
+    return None
+
+
+def find_reposts(processor, con, exclude_accounts=(), max_distance=4, feed_months=None):
+    """
+    Returns {post path: [posts of other shortcodes with a similar image]}, oldest
+    first. Only images that were hashed before (see ImageHashCache) are used.
+    `feed_months` is the window of rendered feed pages, older stories are not linked.
+    """
+    image_hashes = load_image_hashes(con)
+    if not image_hashes:
+        return {}
+    # same cut-off as load_recent_posts, which selects the posts of the feed pages
+    feed_since = int((datetime.now() - timedelta(days=feed_months * 30)).timestamp()) if feed_months else None
+
+    posts = {}
+    rows = con.execute(f"""
+        SELECT DISTINCT p.path, p.shortcode, p.type, p.timestamp, m.username, m.year, m.dir
+        FROM {processor.posts_tbl} p
+        JOIN {processor.posts_metadata_tbl} m ON p.path = m.path
+    """)
+    for row in rows:
+        if row["username"] not in exclude_accounts:
+            posts[JSON_SUFFIX.sub("", row["path"])] = dict(row)
+
+    hashes, post_keys = [], []
+    for path, value in image_hashes.items():
+        key = IMAGE_SUFFIX.sub("", path)
+        # 0 is the hash of flat images (blank frames, single color backgrounds)
+        if key in posts and value != 0:
+            hashes.append(value)
+            post_keys.append(key)
+    if not hashes:
+        return {}
+    index = HammingIndex(np.array(hashes, dtype=np.int64).view(np.uint64), post_keys)
+
+    similar = defaultdict(set)
+    groups = [set(ids) for ids in index.ids if len(set(ids)) > 1]
+    groups += [set(index.ids[i]) | set(index.ids[j]) for i, j in index.pairs(max_distance)]
+    for group in groups:
+        for key in group:
+            similar[key].update(group)
+
+    reposts = {}
+    for key, others in similar.items():
+        post = posts[key]
+        links = {}
+        for other in sorted((posts[k] for k in others), key=lambda p: p["timestamp"] or 0):
+            url = post_url(other, feed_since)
+            if url and other["shortcode"] != post["shortcode"] and other["shortcode"] not in links:
+                links[other["shortcode"]] = {
+                    "username": other["username"],
+                    "shortcode": other["shortcode"],
+                    "type": other["type"],
+                    "timestamp": other["timestamp"],
+                    "date": datetime.fromtimestamp(other["timestamp"]).strftime("%Y-%m-%d") if other["timestamp"] else "",
+                    "url": url
+                }
+        if links:
+            reposts[post["path"]] = list(links.values())[:MAX_LINKS]
+    return reposts
+
+
+def find_similar_images(con, path, max_distance=8):
+    """
+    Images within `max_distance` bits of the image at `path`, as [(distance, path)].
+    """
+    image_hashes = load_image_hashes(con)
+    paths = list(image_hashes)
+    index = HammingIndex(np.array([image_hashes[p] for p in paths], dtype=np.int64).view(np.uint64), paths)
+    value = image_hashes.get(path)
+    if value is None:
+        value = dhash(path)
+    else:
+        value = value & ((1 << 64) - 1)
+    start = time.perf_counter()
+    matches = index.query(value, max_distance)
+    logging.info(f"Searched {len(index.hashes)} distinct hashes in {(time.perf_counter() - start) * 1000:.1f} ms")
+    return matches